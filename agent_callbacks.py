@@ -0,0 +1,195 @@
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from uuid import UUID
+from langchain.callbacks.base import BaseCallbackHandler
+from conversation_memory import count_message_tokens
+import logging
+
+logger = logging.getLogger(__name__)
+
+# tools whose input is the SQL text that will be executed
+SQL_INPUT_TOOLS = {"Execute_SQL"}
+# tools whose output is generated SQL text, or ends with it after GENERATED_SQL_MARKER
+SQL_OUTPUT_TOOLS = {"Generate_SQL", "Search_And_Generate_SQL"}
+GENERATED_SQL_MARKER = "Generated SQL:\n"
+
+
+def _sql_from_output(output: str) -> str:
+    """The SQL text of a SQL_OUTPUT_TOOLS output."""
+    _, marker, sql = output.rpartition(GENERATED_SQL_MARKER)
+    return sql.strip() if marker else output
+
+
+class EventBatcher:
+    """Coalesce agent events and deliver them in batches.
+
+    Events added within `interval` seconds of each other are sent together
+    through `send`. A tool_start still waiting in the batch when its tool_end
+    arrives is merged with it into a single `tool` event.
+    """
+
+    def __init__(self, send: Callable[[List[Dict[str, Any]]], None],
+                 interval: float = 0.25, max_batch: int = 50):
+        self.send = send
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._closed = False
+
+    def add(self, event: Dict[str, Any]):
+        with self._lock:
+            if self._closed:
+                return
+            if not self._coalesce(event):
+                self._pending.append(event)
+            if len(self._pending) >= self.max_batch:
+                batch = self._take()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch:
+            self._send(batch)
+
+    def _coalesce(self, event: Dict[str, Any]) -> bool:
+        """Merge a tool_end into its pending tool_start, if any."""
+        if event["type"] != "tool_end":
+            return False
+        for i, pending in enumerate(self._pending):
+            if pending["type"] == "tool_start" and pending["run_id"] == event["run_id"]:
+                self._pending[i] = {**pending, **event, "type": "tool"}
+                return True
+        return False
+
+    def _take(self) -> List[Dict[str, Any]]:
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _send(self, batch: List[Dict[str, Any]]):
+        try:
+            self.send(batch)
+        except Exception as e:
+            logger.error(f"error sending agent events: {str(e)}")
+
+    def flush(self):
+        """Send every pending event now."""
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    def close(self):
+        """Flush the remaining events and ignore any that arrive later."""
+        with self._lock:
+            batch = self._take()
+            self._closed = True
+        if batch:
+            self._send(batch)
+
+
+class AgentEventHandler(BaseCallbackHandler):
+    """Turn LangChain callbacks of one agent run into structured progress events."""
+
+    def __init__(self, sink: Callable[[Dict[str, Any]], None]):
+        self.sink = sink
+        self.started_at = time.perf_counter()
+        self._runs: Dict[UUID, Dict[str, Any]] = {}
+
+    def _elapsed_ms(self, since: Optional[float] = None) -> float:
+        return round((time.perf_counter() - (since or self.started_at)) * 1000, 1)
+
+    def _emit(self, event: Dict[str, Any]):
+        event["elapsed_ms"] = self._elapsed_ms()
+        self.sink(event)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *,
+                     run_id: UUID, **kwargs: Any) -> None:
+        self._runs[run_id] = {"start": time.perf_counter()}
+        self._emit({"type": "llm_start", "run_id": str(run_id)})
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *,
+                            run_id: UUID, **kwargs: Any) -> None:
+        self._runs[run_id] = {"start": time.perf_counter()}
+        self._emit({
+            "type": "llm_start",
+            "run_id": str(run_id),
+            "prompt_tokens": sum(count_message_tokens(batch) for batch in messages),
+        })
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, {})
+        event = {"type": "llm_end", "run_id": str(run_id)}
+        if "start" in run:
+            event["duration_ms"] = self._elapsed_ms(run["start"])
+        token_usage = (getattr(response, "llm_output", None) or {}).get("token_usage")
+        if token_usage:
+            event["token_usage"] = dict(token_usage)
+        self._emit(event)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._runs.pop(run_id, None)
+        self._emit({"type": "llm_error", "run_id": str(run_id), "error": str(error)})
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *,
+                      run_id: UUID, **kwargs: Any) -> None:
+        name = serialized.get("name", "tool")
+        self._runs[run_id] = {"start": time.perf_counter(), "tool": name}
+        event = {"type": "tool_start", "run_id": str(run_id), "tool": name, "input": input_str}
+        if name in SQL_INPUT_TOOLS:
+            event["sql"] = input_str
+        self._emit(event)
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, {})
+        name = run.get("tool", "tool")
+        output = str(output)
+        event = {
+            "type": "tool_end",
+            "run_id": str(run_id),
+            "tool": name,
+            "output": output[:500],
+        }
+        if "start" in run:
+            event["duration_ms"] = self._elapsed_ms(run["start"])
+        if name in SQL_OUTPUT_TOOLS:
+            event["sql"] = _sql_from_output(output)
+        self._emit(event)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, {})
+        self._emit({
+            "type": "tool_error",
+            "run_id": str(run_id),
+            "tool": run.get("tool", "tool"),
+            "error": str(error),
+        })
+
+
+class TokenStreamHandler(BaseCallbackHandler):
+    """Forward answer tokens and tool steps of an agent run to a sink as they happen."""
+
+    def __init__(self, sink: Callable[[Dict[str, Any]], None]):
+        self.sink = sink
+        self._tools: Dict[UUID, str] = {}
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        # tool-call generations stream empty content, only answer text is forwarded
+        if token:
+            self.sink({"type": "token", "token": token})
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *,
+                      run_id: UUID, **kwargs: Any) -> None:
+        name = serialized.get("name", "tool")
+        self._tools[run_id] = name
+        self.sink({"type": "step", "tool": name, "input": input_str})
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self.sink({"type": "step_result", "tool": self._tools.pop(run_id, "tool"), "output": str(output)})
@@ -1,18 +1,18 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, abort, render_template, request, jsonify, send_file
 from flask_socketio import SocketIO, emit
+import hmac
 import os
 from werkzeug.utils import secure_filename
-import sys
-import io
-from contextlib import redirect_stdout
-import threading
-import queue
-import time
 from geo_rag_agent import GeoRAGAgent
 import logging
-import re
-from document_processor import DocumentProcessor
+from agent_callbacks import AgentEventHandler, EventBatcher
+from document_processor import DEFAULT_COLLECTION
 from file_upload_handler import FileUploadHandler
+from metrics import observe, request_trace
+from profiling import Profiler
+from prometheus_client import REGISTRY
+from prometheus_client.exposition import choose_encoder
+from session_manager import AdmissionRejected, QueryWorkerPool, RateLimiter
 from dotenv import load_dotenv
 
 app = Flask(__name__)
@@ -23,65 +23,39 @@ socketio = SocketIO(app)
 # 确保上传目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# 创建输出队列
-output_queue = queue.Queue()
-
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# ANSI 颜色代码的正则表达式
-ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-
 # 加载环境变量
 load_dotenv()
 
 # 初始化处理器
 upload_handler = FileUploadHandler(socketio=socketio)
-doc_processor = DocumentProcessor(openai_api_key=os.getenv("OPENAI_API_KEY"))
 agent = GeoRAGAgent()
-
-class TerminalOutputCapture:
-    def __init__(self, queue):
-        self.queue = queue
-        self.buffer = io.StringIO()
-        self.original_stdout = sys.stdout
-        self.original_stderr = sys.stderr
-
-    def write(self, text):
-        # 移除 ANSI 颜色代码
-        clean_text = ansi_escape.sub('', text)
-        self.buffer.write(clean_text)
-        self.queue.put(clean_text)
-        self.original_stdout.write(text)
-
-    def flush(self):
-        self.buffer.flush()
-        self.original_stdout.flush()
-
-    def __enter__(self):
-        sys.stdout = self
-        sys.stderr = self
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stdout = self.original_stdout
-        sys.stderr = self.original_stderr
-
-def process_output():
-    """process the output queue and send to web socket"""
-    while True:
-        try:
-            message = output_queue.get()
-            if message:
-                socketio.emit('terminal_output', {'data': message})
-            time.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Error processing output: {str(e)}")
-
-# 启动输出处理线程
-output_thread = threading.Thread(target=process_output, daemon=True)
-output_thread.start()
+# 上传的文档写入代理正在检索的同一组索引分片，新集合无需重启即可查询
+doc_processor = agent.doc_processor
+query_pool = QueryWorkerPool()
+# 限流和排队的拒绝计入同一处，/admission/stats 能看到全部拒绝原因
+rate_limiter = RateLimiter(rejections=query_pool.rejections)
+profiler = Profiler()
+
+def is_admin(token):
+    """check an admin token against ADMIN_TOKEN; admin features are off when it is unset"""
+    admin_token = os.getenv('ADMIN_TOKEN')
+    return bool(admin_token and token and hmac.compare_digest(token, admin_token))
+
+def request_admin_token():
+    auth = request.headers.get('Authorization', '')
+    return auth[7:] if auth.startswith('Bearer ') else request.headers.get('X-Admin-Token')
+
+def parse_collections(value):
+    """collections to search: a name, a comma separated string or a list; None searches all of them"""
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.split(',')
+    return [str(name).strip() for name in value if str(name).strip()] or None
 
 @app.route('/')
 def index():
@@ -97,8 +71,15 @@ def upload_file():
         return jsonify({'success': False, 'message': 'No selected file'})
     
     # 处理文件上传
-    success, message = upload_handler.handle_upload(file, doc_processor)
-    return jsonify({'success': success, 'message': message})
+    # 管理员可以通过 profile=true 对本次上传做性能剖析
+    requested = request.form.get('profile') == 'true' and is_admin(request_admin_token())
+    # 文档写入指定集合（各自独立的索引分片），未指定时写入默认集合
+    collection = request.form.get('collection') or DEFAULT_COLLECTION
+    with request_trace() as trace:
+        with profiler.capture('upload', file.filename, requested) as profile:
+            success, message = upload_handler.handle_upload(file, doc_processor, collection)
+    return jsonify({'success': success, 'message': message, 'collection': collection,
+                    'trace_id': trace.trace_id, 'profile_id': profile['profile_id']})
 
 @app.route('/query', methods=['POST'])
 def query():
@@ -106,14 +87,117 @@ def query():
     if not data or 'query' not in data:
         return jsonify({'success': False, 'message': 'No query provided'})
     
+    # HTTP 会话与 Socket.IO 会话使用不同的命名空间，避免通过 sid 读写他人的对话
+    session_id = f"http:{data['session_id']}" if data.get('session_id') else None
     try:
-        # 执行查询
-        result = agent.run(data['query'])
-        return jsonify({'success': True, 'result': result})
+        # 准入控制：按客户端限流，工作线程和等待队列都满时立即拒绝并给出重试时间
+        rate_limiter.check(request.remote_addr)
+        # 在工作线程池中执行查询，受全局并发数和单会话并发数限制
+        future = query_pool.submit(session_id or f"http-addr:{request.remote_addr}",
+                                   run_http_query, data['query'], session_id,
+                                   bool(data.get('profile')) and is_admin(request_admin_token()),
+                                   parse_collections(data.get('collections')))
+        result, history_tokens, trace_id, profile_id = future.result()
+        return jsonify({'success': True, 'result': result, 'history_tokens': history_tokens,
+                        'trace_id': trace_id, 'profile_id': profile_id})
+    except AdmissionRejected as e:
+        response = jsonify({'success': False, 'message': str(e), 'reason': e.reason,
+                            'retry_after': e.retry_after_seconds})
+        return response, 429, {'Retry-After': str(e.retry_after_seconds)}
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}")
         return jsonify({'success': False, 'message': str(e)})
 
+def run_http_query(query, session_id, profile=False, collections=None):
+    """run a query in a worker thread under its own trace id"""
+    with request_trace() as trace:
+        logger.info(f"[{trace.trace_id}] http query from session {session_id}")
+        with profiler.capture('query', query, profile) as captured:
+            result, agent_trace = agent.run_with_trace(query, session_id, collections=collections)
+        return result, agent_trace['history_tokens'], trace.trace_id, captured['profile_id']
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Prometheus 抓取各阶段延迟和 LLM token 计数；OpenMetrics 格式附带 trace id 示例
+    encoder, content_type = choose_encoder(request.headers.get('Accept'))
+    return Response(encoder(REGISTRY), content_type=content_type)
+
+@app.route('/admin/profiles')
+def list_profiles():
+    # 列出环形缓冲区中保存的性能剖析结果，需要 ADMIN_TOKEN
+    if not is_admin(request_admin_token()):
+        abort(404)
+    return jsonify({'sample_rate': profiler.sample_rate, 'profiles': profiler.store.list()})
+
+@app.route('/admin/profiles/<profile_id>')
+def download_profile(profile_id):
+    # 下载 cProfile 文件（可用 snakeviz 或 pstats 查看），?format=json 返回阶段耗时和热点函数
+    if not is_admin(request_admin_token()):
+        abort(404)
+    ext = '.json' if request.args.get('format') == 'json' else '.prof'
+    path = profiler.store.path(profile_id, ext)
+    if path is None:
+        abort(404)
+    return send_file(os.path.abspath(path), as_attachment=ext == '.prof', download_name=profile_id + ext)
+
+@app.route('/router/stats')
+def router_stats():
+    # 快速路径的命中率和节省的延迟
+    if agent.router is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **agent.router.stats()})
+
+@app.route('/admission/stats')
+def admission_stats():
+    # 工作线程池的负载、队列长度和拒绝次数，用于调整容量
+    return jsonify(query_pool.stats())
+
+@app.route('/collections')
+def list_collections():
+    # 已加载的文档集合及其分块数量
+    return jsonify({'collections': doc_processor.list_collections()})
+
+@app.route('/retrieval/stats')
+def retrieval_stats():
+    # 检索上下文压缩节省的 token 数
+    return jsonify(agent.context_compressor.stats())
+
+def run_session_query(sid, query, profile=False, collections=None):
+    """run a query in a worker thread and send the answer to the client that asked"""
+    with request_trace() as trace:
+        logger.info(f"[{trace.trace_id}] query from session {sid}")
+        with profiler.capture('query', query, profile):
+            # 代理的执行进度通过回调生成结构化事件，合并成批后只发送到发起查询的客户端
+            batcher = EventBatcher(
+                lambda events: socketio.emit('agent_event', {'events': events, 'trace_id': trace.trace_id}, to=sid),
+                interval=float(os.getenv('AGENT_EVENT_INTERVAL', '0.25'))
+            )
+            try:
+                # 流式执行查询，答案的 token 生成后立即发送给客户端
+                for event in agent.stream(query, session_id=sid,
+                                          callbacks=[AgentEventHandler(batcher.add)],
+                                          collections=collections):
+                    if event['type'] == 'token':
+                        socketio.emit('query_token', {'data': event['token']}, to=sid)
+                    elif event['type'] == 'final':
+                        batcher.close()
+                        # 发送最终响应
+                        with observe('socketio_emit'):
+                            socketio.emit('query_response', {
+                                'data': event['output'],
+                                'trace_id': trace.trace_id,
+                                'time_to_first_token_ms': event['time_to_first_token_ms'],
+                                'total_ms': event['total_ms'],
+                                'parallel_saved_ms': event['parallel_saved_ms'],
+                                'history_tokens': event['history_tokens'],
+                                'stages_ms': trace.timings_ms(),
+                                'tables': event['tables']
+                            }, to=sid)
+            except Exception as e:
+                batcher.close()
+                logger.error(f"[{trace.trace_id}] Error processing query: {str(e)}")
+                socketio.emit('error', {'data': str(e), 'trace_id': trace.trace_id}, to=sid)
+
 @socketio.on('query')
 def handle_query(data):
     query = data.get('query', '')
@@ -121,15 +205,21 @@ def handle_query(data):
         return
     
     try:
-        # 创建新的输出捕获器
-        with TerminalOutputCapture(output_queue):
-            # 执行查询
-            response = agent.run(query)
-            # 发送最终响应
-            emit('query_response', {'data': response})
+        rate_limiter.check(request.remote_addr)
+        # 每个 Socket.IO 会话拥有独立的对话历史，查询在线程池中并行执行
+        query_pool.submit(request.sid, run_session_query, request.sid, query,
+                          bool(data.get('profile')) and is_admin(data.get('admin_token')),
+                          parse_collections(data.get('collections')))
+    except AdmissionRejected as e:
+        emit('busy', {'data': str(e), 'reason': e.reason, 'retry_after': e.retry_after_seconds})
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}")
         emit('error', {'data': str(e)})
 
+@socketio.on('disconnect')
+def handle_disconnect():
+    # 会话结束时释放其对话历史
+    agent.clear_session(request.sid)
+
 if __name__ == '__main__':
     socketio.run(app, debug=True) 
\ No newline at end of file
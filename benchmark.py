@@ -0,0 +1,307 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain_core.documents import Document
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import StaticPool
+
+from document_processor import DocumentProcessor
+from fake_models import FakeEmbeddings, FakeStreamingChatModel, tool_call_message
+from geo_db_toolkit import GeoDatabaseToolkit
+from geo_rag_agent import GeoRAGAgent
+
+COUNTRIES = [("China", "CHN"), ("Japan", "JPN"), ("India", "IND"), ("France", "FRA"),
+             ("United States of America", "USA"), ("Brazil", "BRA")]
+FEATURES = ["Populated place", "Admin-0 capital", "Admin-1 capital", "Port"]
+TOPICS = ["urban development", "river port", "historic district", "railway hub", "industrial park",
+          "university town", "coastal tourism", "mountain reserve", "tea plantation", "silk trade"]
+SEARCH_QUERIES = ["Which river ports are mentioned?", "history of the silk trade",
+                  "university towns near the coast", "industrial park regulations", "railway hub growth"]
+AGENT_SQL = "SELECT name, adm0name, pop_max FROM places ORDER BY pop_max DESC LIMIT 20"
+# the same question answered by a scan of places and by an aggregate view
+AGGREGATE_QUERIES = {
+    "places_per_country": (
+        "SELECT adm0name, COUNT(*) AS place_count FROM places GROUP BY adm0name ORDER BY place_count DESC",
+        "SELECT adm0name, place_count FROM places_by_country ORDER BY place_count DESC",
+    ),
+    "population_by_province": (
+        "SELECT adm0name, adm1name, SUM(pop_max) AS total_population FROM places "
+        "GROUP BY adm0name, adm1name ORDER BY total_population DESC LIMIT 20",
+        "SELECT adm0name, adm1name, total_population FROM places_by_province "
+        "ORDER BY total_population DESC LIMIT 20",
+    ),
+    "largest_place_per_country": (
+        "SELECT adm0name, name, pop_max FROM (SELECT adm0name, name, pop_max, ROW_NUMBER() OVER "
+        "(PARTITION BY adm0name ORDER BY pop_max DESC) AS r FROM places) ranked WHERE r = 1",
+        "SELECT adm0name, largest_place, max_population FROM places_by_country",
+    ),
+}
+
+
+def create_places_standin(rows: int, seed: int = 0) -> Engine:
+    """In-memory SQLite database with a places table shaped like the PostGIS one."""
+    engine = create_engine(
+        "sqlite://",
+        poolclass=StaticPool,
+        connect_args={"check_same_thread": False}
+    )
+    rng = random.Random(seed)
+    with engine.begin() as connection:
+        connection.execute(text("""
+            CREATE TABLE places (
+                gid INTEGER PRIMARY KEY, name TEXT, name_en TEXT, name_zh TEXT, featurecla TEXT,
+                adm0name TEXT, adm0_a3 TEXT, adm1name TEXT,
+                latitude REAL, longitude REAL, pop_max REAL, pop_min REAL
+            )
+        """))
+        records = []
+        for gid in range(rows):
+            country, code = rng.choice(COUNTRIES)
+            pop_max = rng.randint(1_000, 25_000_000)
+            records.append({
+                "gid": gid, "name": f"Place {gid}", "name_en": f"Place {gid}", "name_zh": f"地点{gid}",
+                "featurecla": rng.choice(FEATURES), "adm0name": country, "adm0_a3": code,
+                "adm1name": f"{country} Region {gid % 30}",
+                "latitude": rng.uniform(-60, 70), "longitude": rng.uniform(-180, 180),
+                "pop_max": pop_max, "pop_min": pop_max * rng.uniform(0.3, 1.0),
+            })
+        connection.execute(text("""
+            INSERT INTO places VALUES (:gid, :name, :name_en, :name_zh, :featurecla, :adm0name, :adm0_a3,
+                                       :adm1name, :latitude, :longitude, :pop_max, :pop_min)
+        """), records)
+    return engine
+
+
+def synthetic_documents(count: int, paragraphs: int, seed: int = 0) -> List[Document]:
+    """Deterministic multi-paragraph documents about random places and topics."""
+    rng = random.Random(seed)
+    documents = []
+    for i in range(count):
+        body = []
+        for p in range(paragraphs):
+            topic = rng.choice(TOPICS)
+            body.append(
+                f"Section {p} of report {i} covers the {topic} of Place {rng.randint(0, 999)}. "
+                f"The {topic} grew by {rng.randint(1, 40)} percent after {rng.randint(1950, 2020)}, "
+                f"according to the regional planning office. Residents describe the {topic} as "
+                f"central to the local economy and to daily life in the district."
+            )
+        documents.append(Document(page_content="\n\n".join(body), metadata={"source": f"report_{i}.txt"}))
+    return documents
+
+
+def sample(fn: Callable[[], Any], repeat: int) -> List[float]:
+    """Run fn repeatedly and return the duration of every call in seconds."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarize(durations: List[float]) -> Dict[str, float]:
+    ordered = sorted(durations)
+    return {
+        "n": len(ordered),
+        "mean_ms": round(statistics.mean(ordered) * 1000, 3),
+        "p50_ms": round(ordered[int(0.50 * (len(ordered) - 1))] * 1000, 3),
+        "p99_ms": round(ordered[int(0.99 * (len(ordered) - 1))] * 1000, 3),
+    }
+
+
+def bench_startup(args, index_dir: str) -> Dict[str, float]:
+    """Cold import time of the agent module and construction time with fakes."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import geo_rag_agent"], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    import_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    create_agent(DocumentProcessor(embeddings=FakeEmbeddings(), index_path=index_dir),
+                 GeoDatabaseToolkit(engine=create_places_standin(10), llm=FakeStreamingChatModel(responses=["-"])))
+    construct_s = time.perf_counter() - start
+    return {"import_s": round(import_s, 3), "construct_s": round(construct_s, 3)}
+
+
+def bench_ingest(args, processor: DocumentProcessor) -> Dict[str, float]:
+    """Split, embed, index and save synthetic documents."""
+    documents = synthetic_documents(args.docs, args.paragraphs)
+    start = time.perf_counter()
+    chunks = processor.process_documents(documents)
+    seconds = time.perf_counter() - start
+    return {"documents": len(documents), "chunks": len(chunks), "seconds": round(seconds, 3),
+            "chunks_per_s": round(len(chunks) / seconds, 1)}
+
+
+def bench_search(args, processor: DocumentProcessor) -> Dict[str, float]:
+    queries = iter(SEARCH_QUERIES * args.repeat)
+    return summarize(sample(lambda: processor.search_documents(next(queries)), args.repeat))
+
+
+def bench_collections(args, index_dir: str, shards: int = 4) -> Dict[str, Any]:
+    """The synthetic documents split over several collections: fan-out search vs one shard."""
+    processor = DocumentProcessor(embeddings=FakeEmbeddings(), index_path=os.path.join(index_dir, "sharded"))
+    documents = synthetic_documents(args.docs, args.paragraphs)
+    # every shard needs at least one document
+    shards = max(1, min(shards, len(documents)))
+    for i in range(shards):
+        processor.process_documents(documents[i::shards], collection=f"shard{i}")
+    queries = iter(SEARCH_QUERIES * args.repeat * 2)
+    return {
+        "collections": shards,
+        "fan_out": summarize(sample(lambda: processor.search_documents(next(queries)), args.repeat)),
+        "single": summarize(sample(lambda: processor.search_documents(next(queries), collections=["shard0"]),
+                                   args.repeat)),
+    }
+
+
+def bench_search_tool(args, agent: GeoRAGAgent) -> Dict[str, float]:
+    """The agent's Document_Search tool: MMR over-fetch plus context compression."""
+    queries = iter(SEARCH_QUERIES * args.repeat)
+    return summarize(sample(lambda: agent._search_documents(next(queries)), args.repeat))
+
+
+def bench_execute_query(args, toolkit: GeoDatabaseToolkit) -> Dict[str, float]:
+    """Toolkit execute_query latency and its overhead over a raw driver call."""
+    def raw():
+        with toolkit.engine.connect() as connection:
+            connection.execute(text(AGENT_SQL)).fetchall()
+
+    raw_stats = summarize(sample(raw, args.repeat))
+    stats = summarize(sample(lambda: toolkit.execute_query(AGENT_SQL), args.repeat))
+    stats["raw_p50_ms"] = raw_stats["p50_ms"]
+    stats["overhead_p50_ms"] = round(stats["p50_ms"] - raw_stats["p50_ms"], 3)
+    return stats
+
+
+def bench_aggregates(args, toolkit: GeoDatabaseToolkit) -> Dict[str, Any]:
+    """Aggregate questions answered by scanning places versus reading the aggregate views."""
+    start = time.perf_counter()
+    toolkit.create_aggregate_views()
+    metrics: Dict[str, Any] = {"create_s": round(time.perf_counter() - start, 3)}
+    start = time.perf_counter()
+    toolkit.refresh_aggregate_views()
+    metrics["refresh_s"] = round(time.perf_counter() - start, 3)
+    for name, (raw_sql, view_sql) in AGGREGATE_QUERIES.items():
+        raw = summarize(sample(lambda: toolkit.execute_query(raw_sql), args.repeat))
+        view = summarize(sample(lambda: toolkit.execute_query(view_sql), args.repeat))
+        metrics[name] = {"raw_p50_ms": raw["p50_ms"], "view_p50_ms": view["p50_ms"],
+                         "speedup": round(raw["p50_ms"] / view["p50_ms"], 1) if view["p50_ms"] else None}
+    return metrics
+
+
+def create_agent(processor: DocumentProcessor, toolkit: GeoDatabaseToolkit) -> GeoRAGAgent:
+    """Agent whose scripted LLM calls Execute_SQL once, then answers."""
+    llm = FakeStreamingChatModel(responses=[tool_call_message("Execute_SQL", AGENT_SQL), "Here are the places."])
+    agent = GeoRAGAgent(llm=llm, doc_processor=processor, db_toolkit=toolkit)
+    # measure the agent loop itself, not the SQL fast path
+    agent.router = None
+    return agent
+
+
+def bench_agent(args, agent: GeoRAGAgent, execute_query_p50_ms: float) -> Dict[str, float]:
+    """End-to-end agent.run with a zero-latency LLM: everything measured is our own overhead."""
+    def one_run():
+        agent.run("Which places have the largest population?", session_id="bench")
+        agent.clear_session("bench")
+
+    stats = summarize(sample(one_run, args.repeat))
+    stats["orchestration_overhead_p50_ms"] = round(stats["p50_ms"] - execute_query_p50_ms, 3)
+    return stats
+
+
+def flatten(metrics: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in metrics.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """List metrics that got worse than the baseline by more than threshold (a fraction)."""
+    regressions = []
+    now, before = flatten(current["metrics"]), flatten(baseline["metrics"])
+    for name, value in sorted(now.items()):
+        old = before.get(name)
+        if not old or name.endswith(".n"):
+            continue
+        if name.endswith("_per_s"):
+            change = (old - value) / old
+        elif name.endswith("_ms") or name.endswith("_s"):
+            change = (value - old) / old
+        else:
+            continue
+        print(f"{name:<55} {old:>12.3f} -> {value:>12.3f}  ({change:+.1%} worse)" if change > 0
+              else f"{name:<55} {old:>12.3f} -> {value:>12.3f}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Offline benchmarks with fake LLM, fake embeddings and an in-memory database')
+    parser.add_argument('--output', '-o', default='benchmark_results.json', help='Where to write the JSON results')
+    parser.add_argument('--compare', '-c', help='Baseline JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown before a regression, e.g. 0.2 = 20%%')
+    parser.add_argument('--docs', type=int, default=50, help='Synthetic documents to ingest')
+    parser.add_argument('--paragraphs', type=int, default=20, help='Paragraphs per synthetic document')
+    parser.add_argument('--rows', type=int, default=20000, help='Rows of the places stand-in table')
+    parser.add_argument('--repeat', type=int, default=200, help='Samples per latency benchmark')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as index_dir:
+        metrics: Dict[str, Any] = {"startup": bench_startup(args, os.path.join(index_dir, "startup"))}
+
+        processor = DocumentProcessor(embeddings=FakeEmbeddings(), index_path=os.path.join(index_dir, "faiss_index"))
+        toolkit = GeoDatabaseToolkit(engine=create_places_standin(args.rows),
+                                     llm=FakeStreamingChatModel(responses=["-"]))
+
+        metrics["ingest"] = bench_ingest(args, processor)
+        metrics["search_documents"] = bench_search(args, processor)
+        metrics["search_collections"] = bench_collections(args, index_dir)
+        metrics["execute_query"] = bench_execute_query(args, toolkit)
+        metrics["aggregates"] = bench_aggregates(args, toolkit)
+        agent = create_agent(processor, toolkit)
+        metrics["document_search_tool"] = bench_search_tool(args, agent)
+        metrics["agent_run"] = bench_agent(args, agent, metrics["execute_query"]["p50_ms"])
+
+    results = {
+        "version": 1,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "parameters": vars(args),
+        "metrics": metrics,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(metrics, indent=2))
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from fake_models import FakeStreamingChatModel
+from geo_rag_agent import GeoRAGAgent
+from load_test import percentile
+
+
+def create_agent(args) -> GeoRAGAgent:
+    """Create the live agent, or one driven by a fake LLM with simulated latency."""
+    if not args.fake_llm:
+        return GeoRAGAgent()
+    llm = FakeStreamingChatModel(responses=["Shanghai is about 100 km from Suzhou."], latency=args.latency)
+    # the scripted answer never calls a tool, so no document store or database is needed
+    return GeoRAGAgent(llm=llm, doc_processor=SimpleNamespace(), db_toolkit=SimpleNamespace())
+
+
+def run_threaded(agent: GeoRAGAgent, query: str, chats: int, threads: int) -> List[float]:
+    """Run every chat through agent.run on a thread pool."""
+    def one_chat(i: int) -> float:
+        start = time.perf_counter()
+        agent.run(query, session_id=f"threaded-{i}")
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(one_chat, range(chats)))
+
+
+async def run_async(agent: GeoRAGAgent, query: str, chats: int) -> List[float]:
+    """Run every chat concurrently through agent.arun on one event loop."""
+    async def one_chat(i: int) -> float:
+        start = time.perf_counter()
+        await agent.arun(query, session_id=f"async-{i}")
+        return time.perf_counter() - start
+
+    return await asyncio.gather(*(one_chat(i) for i in range(chats)))
+
+
+def report(name: str, latencies: List[float], wall_time: float, threads: int):
+    print(f"{name:>8}: wall {wall_time:.2f}s  "
+          f"throughput {len(latencies) / wall_time:.1f} chats/s  "
+          f"p50 {percentile(latencies, 50):.2f}s  p95 {percentile(latencies, 95):.2f}s  "
+          f"worker threads {threads}")
+
+
+def main(argv: Optional[List[str]] = None):
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description='Compare the threaded and asyncio agent execution paths')
+    parser.add_argument('--chats', '-n', type=int, default=200, help='Number of concurrent chats')
+    parser.add_argument('--threads', type=int, default=8, help='Worker threads of the threaded path')
+    parser.add_argument('--query', default='How far is Shanghai from Suzhou?', help='Question of every chat')
+    parser.add_argument('--fake-llm', action='store_true', help='Use a fake LLM instead of OpenAI')
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds per fake LLM call')
+    args = parser.parse_args(argv)
+
+    agent = create_agent(args)
+
+    start = time.perf_counter()
+    latencies = run_threaded(agent, args.query, args.chats, args.threads)
+    report("threaded", latencies, time.perf_counter() - start, args.threads)
+
+    start = time.perf_counter()
+    latencies = asyncio.run(run_async(agent, args.query, args.chats))
+    report("async", latencies, time.perf_counter() - start, 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from conversation_memory import count_tokens, truncate_tokens
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _shingles(text: str, size: int = 3) -> set:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        # short or CJK text without spaces: fall back to character shingles
+        chars = re.sub(r"\s+", "", text.lower())
+        return {chars[i:i + size] for i in range(max(len(chars) - size + 1, 1))}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def similarity(a: str, b: str) -> float:
+    """Jaccard similarity of the word shingles of two texts."""
+    sa, sb = _shingles(a), _shingles(b)
+    if not sa or not sb:
+        return 0.0
+    return len(sa & sb) / len(sa | sb)
+
+
+def _text_overlap(left: str, right: str, min_overlap: int = 1, max_overlap: int = 200) -> int:
+    """Length of the longest suffix of left that is a prefix of right, or 0 if below min_overlap."""
+    for size in range(min(len(left), len(right), max_overlap), min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+class ContextCompressor:
+    """Shrink retrieved chunks before they are put into the prompt.
+
+    Near-duplicate chunks are dropped, neighbouring chunks of the same
+    source are merged back into one passage, and passages are packed in
+    relevance order into `token_budget` tokens. Chunks without a start
+    index only count as neighbours when they share at least `min_overlap`
+    characters; the default is half of the splitter's 50-character
+    chunk_overlap, which leaves room for whitespace the splitter strips.
+    """
+
+    def __init__(self, token_budget: int = 800, dedup_threshold: float = 0.8,
+                 model_name: str = "gpt-4", min_overlap: int = 25):
+        self.token_budget = token_budget
+        self.dedup_threshold = dedup_threshold
+        self.min_overlap = max(1, min_overlap)
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._stats = {"queries": 0, "tokens_before": 0, "tokens_after": 0}
+
+    @staticmethod
+    def format_passage(content: str, metadata: Dict[str, Any]) -> str:
+        return f"Content: {content}\nSource: {metadata.get('source', 'Unknown')}\n"
+
+    def deduplicate(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Drop chunks that repeat an already kept, more relevant chunk."""
+        kept: List[Dict[str, Any]] = []
+        for result in results:
+            content = result["content"]
+            if any(content in k["content"] or similarity(content, k["content"]) >= self.dedup_threshold
+                   for k in kept):
+                continue
+            kept.append(result)
+        return kept
+
+    def merge_adjacent(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Merge chunks of the same source and page that touch or overlap.
+
+        Chunks carrying a start_index are merged by position, older chunks
+        without one by detecting the splitter overlap in the text. A merged
+        passage keeps the rank of its most relevant chunk.
+        """
+        passages: List[Dict[str, Any]] = []
+        for rank, result in enumerate(results):
+            metadata = result["metadata"]
+            key = (metadata.get("source"), metadata.get("page"))
+            start = metadata.get("start_index")
+            content = result["content"]
+            target = next((p for p in passages
+                           if p["key"] == key and self._merge(p, content, start)), None)
+            if target is None:
+                passages.append({
+                    "key": key,
+                    "rank": rank,
+                    "content": content,
+                    "start": start,
+                    "end": start + len(content) if start is not None else None,
+                    "metadata": metadata,
+                })
+                continue
+            # the grown passage may now bridge the gap to another passage of the same source
+            for other in [p for p in passages if p is not target and p["key"] == key]:
+                if self._merge(target, other["content"], other["start"]):
+                    target["rank"] = min(target["rank"], other["rank"])
+                    passages.remove(other)
+        passages.sort(key=lambda p: p["rank"])
+        return [{"content": p["content"], "metadata": p["metadata"]} for p in passages]
+
+    def _merge(self, passage: Dict[str, Any], content: str, start: Optional[int]) -> bool:
+        if start is not None and passage["start"] is not None:
+            if start <= passage["end"] and start + len(content) >= passage["start"]:
+                if start >= passage["start"]:
+                    passage["content"] += content[passage["end"] - start:]
+                else:
+                    passage["content"] = content + passage["content"][start + len(content) - passage["start"]:]
+                passage["start"] = min(passage["start"], start)
+                passage["end"] = max(passage["end"], start + len(content))
+                return True
+            return False
+        overlap = _text_overlap(passage["content"], content, self.min_overlap)
+        if overlap:
+            passage["content"] += content[overlap:]
+            return True
+        overlap = _text_overlap(content, passage["content"], self.min_overlap)
+        if overlap:
+            passage["content"] = content + passage["content"][overlap:]
+            return True
+        return False
+
+    def pack(self, results: List[Dict[str, Any]]) -> List[str]:
+        """Format passages in order until the token budget is used up."""
+        packed: List[str] = []
+        remaining = self.token_budget
+        for result in results:
+            passage = self.format_passage(result["content"], result["metadata"])
+            tokens = count_tokens(passage, self.model_name)
+            if tokens <= remaining:
+                packed.append(passage)
+                remaining -= tokens
+                continue
+            # truncate the passage that does not fit if a useful part of it still does
+            if remaining >= 50:
+                content = truncate_tokens(result["content"], remaining - 20, self.model_name)
+                packed.append(self.format_passage(content + " ...", result["metadata"]))
+            break
+        return packed
+
+    def compress(self, results: List[Dict[str, Any]]) -> Tuple[str, Dict[str, int]]:
+        """Deduplicate, merge and pack search results into prompt text."""
+        tokens_before = count_tokens(
+            "\n".join(self.format_passage(r["content"], r["metadata"]) for r in results),
+            self.model_name
+        )
+        packed = self.pack(self.merge_adjacent(self.deduplicate(results)))
+        text = "\n".join(packed)
+        tokens_after = count_tokens(text, self.model_name)
+        stats = {
+            "chunks": len(results),
+            "passages": len(packed),
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_after,
+            "tokens_saved": max(tokens_before - tokens_after, 0),
+        }
+        with self._lock:
+            self._stats["queries"] += 1
+            self._stats["tokens_before"] += tokens_before
+            self._stats["tokens_after"] += tokens_after
+        logger.info(
+            f"retrieved context: {stats['chunks']} chunks -> {stats['passages']} passages, "
+            f"{tokens_before} -> {tokens_after} tokens ({stats['tokens_saved']} saved)"
+        )
+        return text, stats
+
+    def stats(self) -> Dict[str, Any]:
+        """Cumulative token savings over all compressed queries."""
+        with self._lock:
+            s = dict(self._stats)
+        s["tokens_saved"] = max(s["tokens_before"] - s["tokens_after"], 0)
+        s["avg_tokens_saved"] = round(s["tokens_saved"] / s["queries"], 1) if s["queries"] else 0.0
+        return s
@@ -0,0 +1,227 @@
+import hashlib
+import re
+import threading
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+import tiktoken
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.messages import BaseMessage, SystemMessage, get_buffer_string
+from langchain_core.pydantic_v1 import Field, PrivateAttr
+import logging
+
+logger = logging.getLogger(__name__)
+
+# per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+_REFERENCE = re.compile(r"ref:([0-9a-f]{10})\]")
+
+
+class _ApproximateEncoding:
+    """Stand-in for a tiktoken encoding of about 4 characters per token."""
+
+    chars_per_token = 4
+
+    def encode(self, text: str) -> List[str]:
+        step = self.chars_per_token
+        return [text[i:i + step] for i in range(0, len(text), step)]
+
+    def decode(self, tokens: List[str]) -> str:
+        return "".join(tokens)
+
+
+@lru_cache(maxsize=None)
+def _encoding(model_name: str):
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken downloads its encodings on first use (or reads them from TIKTOKEN_CACHE_DIR);
+        # token accounting must not take query answering down when that fails
+        logger.warning(f"tiktoken encoding unavailable, approximating token counts: {str(e)}")
+        return _ApproximateEncoding()
+
+
+def count_tokens(text: str, model_name: str = "gpt-4") -> int:
+    """Number of tokens of a text for the given model."""
+    return len(_encoding(model_name).encode(text or ""))
+
+
+def truncate_tokens(text: str, max_tokens: int, model_name: str = "gpt-4") -> str:
+    """First max_tokens tokens of a text."""
+    encoding = _encoding(model_name)
+    return encoding.decode(encoding.encode(text or "")[:max_tokens])
+
+
+def count_message_tokens(messages: List[BaseMessage], model_name: str = "gpt-4") -> int:
+    """Approximate number of prompt tokens used by a list of chat messages."""
+    return sum(count_tokens(str(m.content), model_name) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+class TokenBudgetMemory(BaseChatMemory):
+    """Conversation memory that never exceeds a token budget.
+
+    Recent turns are kept verbatim. When the history grows past
+    `max_token_limit`, the oldest turns are dropped from the buffer; when an
+    `llm` is given they are folded into a running summary by
+    summarize_pending(), which callers run after the answer is sent. The
+    summary is capped at `max_token_limit // 4` tokens and that share is
+    reserved in the budget. Any single message larger than
+    `max_message_tokens`, such as a pasted SQL result table, is stored as a
+    short preview with a reference id; the full text stays available
+    through get_reference() until the message leaves the buffer.
+    """
+
+    memory_key: str = "chat_history"
+    return_messages: bool = True
+    max_token_limit: int = 2000
+    max_message_tokens: int = 300
+    model_name: str = "gpt-4"
+    llm: Optional[BaseLanguageModel] = None
+    summary: str = ""
+    references: Dict[str, str] = Field(default_factory=dict)
+    # pruned messages waiting to be folded into the summary
+    pending: List[BaseMessage] = Field(default_factory=list)
+    last_history_tokens: int = 0
+    _lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+    _summarizing: bool = PrivateAttr(default=False)
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    @property
+    def max_summary_tokens(self) -> int:
+        return self.max_token_limit // 4 if self.llm is not None else 0
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            messages = list(self.chat_memory.messages)
+            if self.summary:
+                messages.insert(0, SystemMessage(content=SUMMARY_PREFIX + self.summary))
+            self.last_history_tokens = count_message_tokens(messages, self.model_name)
+        if self.return_messages:
+            return {self.memory_key: messages}
+        return {self.memory_key: get_buffer_string(messages)}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        """Add a turn and prune the buffer; no LLM call, see summarize_pending()."""
+        input_str, output_str = self._get_input_output(inputs, outputs)
+        with self._lock:
+            self.chat_memory.add_user_message(self._compact(input_str))
+            self.chat_memory.add_ai_message(self._compact(output_str))
+            self._prune()
+
+    async def asave_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        """Add a turn and fold pruned turns into the summary with the async LLM client."""
+        self.save_context(inputs, outputs)
+        await self.asummarize_pending()
+
+    def summarize_pending(self) -> None:
+        """Fold pruned turns into the running summary."""
+        messages = self._start_summary()
+        if not messages:
+            return
+        try:
+            result = self.llm.invoke(self._summarize_prompt(messages))
+        except Exception as e:
+            logger.error(f"error summarizing conversation: {str(e)}")
+            result = None
+        self._finish_summary(messages, result)
+
+    async def asummarize_pending(self) -> None:
+        """Async variant of summarize_pending()."""
+        messages = self._start_summary()
+        if not messages:
+            return
+        try:
+            result = await self.llm.ainvoke(self._summarize_prompt(messages))
+        except Exception as e:
+            logger.error(f"error summarizing conversation: {str(e)}")
+            result = None
+        self._finish_summary(messages, result)
+
+    def get_reference(self, ref_id: str) -> Optional[str]:
+        """Full text of a message that was replaced by a reference."""
+        return self.references.get(ref_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            super().clear()
+            self.summary = ""
+            self.references.clear()
+            self.pending.clear()
+            self.last_history_tokens = 0
+
+    def _compact(self, text: str) -> str:
+        """Replace an oversized message by a preview and a reference id."""
+        tokens = count_tokens(text, self.model_name)
+        if tokens <= self.max_message_tokens:
+            return text
+        ref_id = hashlib.sha1(text.encode("utf-8")).hexdigest()[:10]
+        self.references[ref_id] = text
+        preview = truncate_tokens(text, self.max_message_tokens // 2, self.model_name)
+        return f"{preview} ... [{tokens - self.max_message_tokens // 2} more tokens omitted, ref:{ref_id}]"
+
+    def _prune(self) -> None:
+        """Move the oldest turns out of the buffer until it fits the budget."""
+        messages = list(self.chat_memory.messages)
+        # the summary may grow up to its cap at any time, so its share is always reserved
+        budget = self.max_token_limit
+        if self.max_summary_tokens:
+            budget -= (self.max_summary_tokens + count_tokens(SUMMARY_PREFIX, self.model_name)
+                       + MESSAGE_OVERHEAD_TOKENS)
+        pruned: List[BaseMessage] = []
+        # always keep the latest turn (user message and answer) verbatim
+        while len(messages) > 2 and count_message_tokens(messages, self.model_name) > budget:
+            pruned.extend(messages[:2])
+            messages = messages[2:]
+        if not pruned:
+            return
+        self.chat_memory.messages = messages
+        self._forget_references(pruned, messages)
+        if self.llm is not None:
+            self.pending.extend(pruned)
+        logger.info(f"pruned {len(pruned)} messages from conversation memory")
+
+    def _forget_references(self, pruned: List[BaseMessage], kept: List[BaseMessage]) -> None:
+        """Drop the full text of messages that left the buffer."""
+        kept_ids = {ref for m in kept for ref in _REFERENCE.findall(str(m.content))}
+        for m in pruned:
+            for ref_id in _REFERENCE.findall(str(m.content)):
+                if ref_id not in kept_ids:
+                    self.references.pop(ref_id, None)
+
+    def _start_summary(self) -> List[BaseMessage]:
+        # one summarization at a time; turns pruned meanwhile wait for the next one
+        with self._lock:
+            if self.llm is None or self._summarizing or not self.pending:
+                return []
+            self._summarizing = True
+            messages, self.pending = self.pending, []
+            return messages
+
+    def _finish_summary(self, messages: List[BaseMessage], result: Any) -> None:
+        summary = None
+        if result is not None:
+            summary = truncate_tokens(str(getattr(result, "content", result)).strip(),
+                                      self.max_summary_tokens, self.model_name)
+        with self._lock:
+            if summary is not None:
+                self.summary = summary
+            self._summarizing = False
+        logger.info(f"summarized {len(messages)} pruned messages")
+
+    def _summarize_prompt(self, messages: List[BaseMessage]) -> str:
+        return (
+            "Progressively summarize the conversation, adding onto the previous summary. "
+            "Keep place names, numbers and SQL conclusions, drop raw result rows. "
+            f"Answer in at most {self.max_summary_tokens} tokens.\n\n"
+            f"Current summary:\n{self.summary or '(none)'}\n\n"
+            f"New lines of conversation:\n{get_buffer_string(messages)}\n\n"
+            "New summary:"
+        )
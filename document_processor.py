@@ -1,5 +1,10 @@
+import asyncio
+import contextvars
 import os
-from typing import List, Dict, Any
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
 from langchain_openai import OpenAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import (
@@ -9,6 +14,10 @@ from langchain_community.document_loaders import (
     JSONLoader
 )
 from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
+from metrics import InstrumentedEmbeddings, timed
+from profiling import profiled
 import pickle
 import logging
 
@@ -16,17 +25,80 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DEFAULT_COLLECTION = "default"
+_COLLECTION_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def validate_collection_name(name: str) -> str:
+    """Return the name if it can be used as a collection (and directory) name, else raise ValueError."""
+    if not isinstance(name, str) or not _COLLECTION_NAME.match(name):
+        raise ValueError(f"invalid collection name: {name!r} (use 1-64 letters, digits, '_' or '-')")
+    return name
+
+
 class DocumentProcessor:
-    def __init__(self, openai_api_key: str):
-        self.embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key)
+    """Splits, embeds and searches documents in named collections.
+
+    Every collection is its own FAISS index shard, saved in its own
+    directory: the default collection keeps the legacy `index_path`, the
+    others live under `collections_dir`. Adding documents to a collection
+    only rebuilds and saves that shard, and searches over several
+    collections query the shards in parallel and merge the hits into one
+    global top-k.
+    """
+
+    def __init__(self, openai_api_key: Optional[str] = None, embeddings: Optional[Embeddings] = None,
+                 index_path: str = "faiss_index", collections_dir: Optional[str] = None):
+        # every embedding call is recorded as the "embedding" stage on /metrics
+        self.embeddings = InstrumentedEmbeddings(embeddings or OpenAIEmbeddings(openai_api_key=openai_api_key))
+        self.index_path = index_path
+        self.collections_dir = collections_dir or os.getenv("COLLECTIONS_DIR", f"{index_path}_collections")
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=500,  # 减小块大小
             chunk_overlap=50,  # 减小重叠大小
             length_function=len,
             separators=["\n\n", "\n", "。", "！", "？", ".", "!", "?", " ", ""],  # 添加中文分隔符
-            is_separator_regex=False
+            is_separator_regex=False,
+            add_start_index=True  # 记录块在原文中的位置，检索时用于合并相邻块
+        )
+        self.vectorstores: Dict[str, FAISS] = {}
+        # shards are never changed in place: writers of a collection hold its lock, update a copy
+        # and swap it in, so searches run without locks against a consistent index
+        self._shard_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        # threads for searching several shards at once
+        self._search_pool = ThreadPoolExecutor(
+            max_workers=int(os.getenv("SEARCH_MAX_WORKERS", "4")),
+            thread_name_prefix="geo-shard"
         )
-        self.vectorstore = None
+
+    @property
+    def vectorstore(self) -> Optional[FAISS]:
+        """The shard of the default collection."""
+        return self.vectorstores.get(DEFAULT_COLLECTION)
+
+    @vectorstore.setter
+    def vectorstore(self, store: Optional[FAISS]):
+        with self._lock:
+            if store is None:
+                self.vectorstores.pop(DEFAULT_COLLECTION, None)
+            else:
+                self.vectorstores[DEFAULT_COLLECTION] = store
+
+    def collection_path(self, collection: str = DEFAULT_COLLECTION) -> str:
+        """Directory of a collection's index shard."""
+        if validate_collection_name(collection) == DEFAULT_COLLECTION:
+            return self.index_path
+        return os.path.join(self.collections_dir, collection)
+
+    def _shard_lock(self, collection: str) -> threading.Lock:
+        with self._lock:
+            return self._shard_locks.setdefault(collection, threading.Lock())
+
+    def list_collections(self) -> Dict[str, int]:
+        """Loaded collections and the number of chunks in each."""
+        with self._lock:
+            return {name: store.index.ntotal for name, store in sorted(self.vectorstores.items())}
 
     def load_document(self, file_path: str) -> List[Any]:
         """Load and process a document based on its file extension."""
@@ -72,8 +144,11 @@ class DocumentProcessor:
             logger.error(f"Error processing document: {str(e)}", exc_info=True)
             raise
 
-    def process_documents(self, documents: List[Any]) -> List[Dict[str, Any]]:
-        """Process documents into chunks and generate embeddings."""
+    @timed("index_documents")
+    def process_documents(self, documents: List[Any],
+                          collection: str = DEFAULT_COLLECTION) -> List[Dict[str, Any]]:
+        """Process documents into chunks, embed them and add them to a collection."""
+        validate_collection_name(collection)
         try:
             logger.info("Starting to split documents...")
             # 分割文档
@@ -85,17 +160,21 @@ class DocumentProcessor:
                 logger.warning("Document splitting failed, trying to use original document")
                 chunks = documents
             
-            # 创建或更新 FAISS 向量存储
-            logger.info("Creating/updating vector store...")
-            if self.vectorstore is None:
-                self.vectorstore = FAISS.from_documents(chunks, self.embeddings)
-                logger.info("Created new vector store")
-            else:
-                self.vectorstore.add_documents(chunks)
-                logger.info("Updated existing vector store")
-            
-            # 保存向量存储
-            self.save_vectorstore()
+            # 创建或更新该集合的 FAISS 分片，只保存这一个分片；
+            # 新分片在副本上构建好后再替换，正在进行的检索始终看到完整的旧分片
+            logger.info(f"Creating/updating vector store of collection '{collection}'...")
+            with self._shard_lock(collection):
+                store = self.vectorstores.get(collection)
+                if store is None:
+                    store = FAISS.from_documents(chunks, self.embeddings)
+                    logger.info("Created new vector store")
+                else:
+                    store = self._copy_shard(store)
+                    store.add_documents(chunks)
+                    logger.info("Updated existing vector store")
+                self._save_shard(store, self.collection_path(collection))
+                with self._lock:
+                    self.vectorstores[collection] = store
             
             # 返回处理后的块
             processed_chunks = []
@@ -112,30 +191,46 @@ class DocumentProcessor:
             logger.error(f"Error processing document chunks: {str(e)}", exc_info=True)
             raise
 
-    def save_vectorstore(self, path: str = "faiss_index"):
-        """Save the FAISS vector store to disk."""
+    def _copy_shard(self, store: FAISS) -> FAISS:
+        """Independent copy of a shard, so it can be updated while searches use the original."""
+        # same as FAISS.deserialize_from_bytes, whose keyword arguments differ between versions
+        index, docstore, index_to_docstore_id = pickle.loads(store.serialize_to_bytes())
+        return FAISS(self.embeddings, index, docstore, index_to_docstore_id,
+                     distance_strategy=store.distance_strategy)
+
+    def _save_shard(self, store: FAISS, path: str):
         try:
-            if self.vectorstore is not None:
-                logger.info(f"saving vector store to: {path}")
-                self.vectorstore.save_local(path)
-                logger.info("vector store saved successfully")
-            else:
-                logger.warning("no vector store to save")
+            logger.info(f"saving vector store to: {path}")
+            store.save_local(path)
+            logger.info("vector store saved successfully")
         except Exception as e:
             logger.error(f"error saving vector store: {str(e)}", exc_info=True)
             raise
 
-    def load_vectorstore(self, path: str = "faiss_index") -> bool:
-        """Load the FAISS vector store from disk."""
+    def save_vectorstore(self, path: Optional[str] = None, collection: str = DEFAULT_COLLECTION):
+        """Save the FAISS index shard of a collection to disk."""
+        path = path or self.collection_path(collection)
+        store = self.vectorstores.get(collection)
+        if store is None:
+            logger.warning(f"no vector store to save for collection '{collection}'")
+            return
+        with self._shard_lock(collection):
+            self._save_shard(store, path)
+
+    def load_vectorstore(self, path: Optional[str] = None, collection: str = DEFAULT_COLLECTION) -> bool:
+        """Load the FAISS index shard of a collection from disk."""
+        path = path or self.collection_path(collection)
         try:
             if os.path.exists(path):
                 logger.info(f"loading vector store from: {path}")
                 # 添加 allow_dangerous_deserialization=True 参数
-                self.vectorstore = FAISS.load_local(
+                store = FAISS.load_local(
                     path, 
                     self.embeddings,
                     allow_dangerous_deserialization=True  # 允许反序列化
                 )
+                with self._lock:
+                    self.vectorstores[collection] = store
                 logger.info("vector store loaded successfully")
                 return True
             else:
@@ -145,18 +240,133 @@ class DocumentProcessor:
             logger.error(f"error loading vector store: {str(e)}", exc_info=True)
             return False
 
-    def search_documents(self, query: str, k: int = 3) -> List[Dict[str, Any]]:
-        """Search for relevant documents using FAISS."""
+    def load_vectorstores(self) -> List[str]:
+        """Load the default collection and every collection saved under collections_dir."""
+        names = [DEFAULT_COLLECTION]
+        if os.path.isdir(self.collections_dir):
+            names += sorted(name for name in os.listdir(self.collections_dir)
+                            if name != DEFAULT_COLLECTION and _COLLECTION_NAME.match(name)
+                            and os.path.isdir(os.path.join(self.collections_dir, name)))
+        return [name for name in names if self.load_vectorstore(collection=name)]
+
+    def _shards(self, collections: Optional[List[str]]) -> List[Tuple[str, FAISS]]:
+        """The shards to search: the given collections, or every loaded one."""
+        with self._lock:
+            if collections is None:
+                shards = sorted(self.vectorstores.items())
+            else:
+                unknown = [name for name in collections if name not in self.vectorstores]
+                if unknown:
+                    raise ValueError(f"unknown collection: {', '.join(map(str, unknown))}")
+                shards = [(name, self.vectorstores[name]) for name in dict.fromkeys(collections)]
+        if not shards:
+            raise ValueError("no documents processed, please load documents first")
+        return shards
+
+    def _fan_out(self, shards: List[Tuple[str, FAISS]], search) -> List[Tuple[Document, float]]:
+        """Run search(store) on every shard, in parallel when there are several."""
+        if len(shards) == 1:
+            return search(shards[0][1])
+
+        def run(store):
+            with profiled():
+                return search(store)
+
+        # each shard is searched in a copy of this context so profiles reach the request
+        futures = [self._search_pool.submit(contextvars.copy_context().run, run, store) for _, store in shards]
+        return [hit for future in futures for hit in future.result()]
+
+    @staticmethod
+    def _top_k(hits: List[Tuple[Document, float]], k: int) -> List[Dict[str, Any]]:
+        # every shard uses the default L2 distance, so scores are comparable and lower is better
+        hits = sorted(hits, key=lambda hit: hit[1])[:k]
+        return [{"content": doc.page_content, "metadata": doc.metadata} for doc, _ in hits]
+
+    def _search(self, embedding: List[float], k: int,
+                shards: List[Tuple[str, FAISS]]) -> List[Dict[str, Any]]:
+        hits = self._fan_out(shards, lambda store: store.similarity_search_with_score_by_vector(embedding, k=k))
+        return self._top_k(hits, k)
+
+    def _mmr_search(self, embedding: List[float], k: int, fetch_k: int, lambda_mult: float,
+                    shards: List[Tuple[str, FAISS]]) -> List[Dict[str, Any]]:
+        # MMR runs within each shard; the diverse picks of all shards are merged by distance
+        hits = self._fan_out(shards, lambda store: store.max_marginal_relevance_search_with_score_by_vector(
+            embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult
+        ))
+        return self._top_k(hits, k)
+
+    @timed("search_documents")
+    def search_documents(self, query: str, k: int = 3,
+                         collections: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Search for relevant documents in some collections (default: all) using FAISS."""
         try:
-            if self.vectorstore is None:
-                raise ValueError("no documents processed, please load documents first")
+            shards = self._shards(collections)
             
-            logger.info(f"searching for query: {query}")
-            docs = self.vectorstore.similarity_search(query, k=k)
+            logger.info(f"searching for query in {len(shards)} collections: {query}")
+            docs = self._search(self.embeddings.embed_query(query), k, shards)
             logger.info(f"found {len(docs)} relevant documents")
             
-            return [{"content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+            return docs
             
         except Exception as e:
             logger.error(f"error searching documents: {str(e)}", exc_info=True)
-            raise 
\ No newline at end of file
+            raise
+
+    @timed("search_documents")
+    def mmr_search_documents(self, query: str, k: int = 8, fetch_k: int = 20, lambda_mult: float = 0.5,
+                             collections: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Over-fetch fetch_k candidates and keep k relevant but diverse ones (MMR)."""
+        try:
+            shards = self._shards(collections)
+            
+            logger.info(f"searching for query (mmr) in {len(shards)} collections: {query}")
+            docs = self._mmr_search(self.embeddings.embed_query(query), k, fetch_k, lambda_mult, shards)
+            logger.info(f"found {len(docs)} relevant documents")
+            
+            return docs
+            
+        except Exception as e:
+            logger.error(f"error searching documents: {str(e)}", exc_info=True)
+            raise
+
+    @timed("search_documents")
+    async def ammr_search_documents(self, query: str, k: int = 8, fetch_k: int = 20, lambda_mult: float = 0.5,
+                                    collections: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Async variant of mmr_search_documents."""
+        try:
+            shards = self._shards(collections)
+            
+            logger.info(f"searching for query (mmr) in {len(shards)} collections: {query}")
+            embedding = await self.embeddings.aembed_query(query)
+            # the FAISS searches are CPU bound, keep them off the event loop
+            docs = await asyncio.get_running_loop().run_in_executor(
+                None, contextvars.copy_context().run,
+                self._mmr_search, embedding, k, fetch_k, lambda_mult, shards
+            )
+            logger.info(f"found {len(docs)} relevant documents")
+            
+            return docs
+            
+        except Exception as e:
+            logger.error(f"error searching documents: {str(e)}", exc_info=True)
+            raise
+
+    @timed("search_documents")
+    async def asearch_documents(self, query: str, k: int = 3,
+                                collections: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Search for relevant documents using the async embeddings client."""
+        try:
+            shards = self._shards(collections)
+            
+            logger.info(f"searching for query in {len(shards)} collections: {query}")
+            embedding = await self.embeddings.aembed_query(query)
+            docs = await asyncio.get_running_loop().run_in_executor(
+                None, contextvars.copy_context().run, self._search, embedding, k, shards
+            )
+            logger.info(f"found {len(docs)} relevant documents")
+            
+            return docs
+            
+        except Exception as e:
+            logger.error(f"error searching documents: {str(e)}", exc_info=True)
+            raise
@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import json
+import math
+import re
+import time
+from typing import Any, Dict, List, Optional, Union
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+
+def tool_call_message(tool: str, tool_input: str, call_id: str = "call_1") -> AIMessage:
+    """Build an AIMessage that asks the agent to call one tool, as OpenAI tools would."""
+    return AIMessage(
+        content="",
+        additional_kwargs={
+            "tool_calls": [{
+                "id": call_id,
+                "type": "function",
+                "function": {"name": tool, "arguments": json.dumps({"__arg1": tool_input})},
+            }]
+        },
+    )
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """Chat model replaying scripted responses, streaming text ones token by token.
+
+    Each entry of `responses` is either answer text or a prepared AIMessage
+    (e.g. from tool_call_message). Text responses are reported through
+    on_llm_new_token word by word, like a streaming OpenAI model. `latency`
+    seconds are spent per call, blocking in _generate and awaiting in
+    _agenerate, to stand in for the network round trip.
+    """
+
+    responses: List[Union[str, AIMessage]]
+    index: int = 0
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming-chat"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None,
+                  **kwargs: Any) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        response = self._next_response()
+        if isinstance(response, str):
+            for token in self._tokens(response):
+                if run_manager:
+                    run_manager.on_llm_new_token(token)
+            response = AIMessage(content=response)
+        return ChatResult(generations=[ChatGeneration(message=response)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                         **kwargs: Any) -> ChatResult:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        response = self._next_response()
+        if isinstance(response, str):
+            for token in self._tokens(response):
+                if run_manager:
+                    await run_manager.on_llm_new_token(token)
+            response = AIMessage(content=response)
+        return ChatResult(generations=[ChatGeneration(message=response)])
+
+    def _next_response(self) -> Union[str, AIMessage]:
+        response = self.responses[self.index % len(self.responses)]
+        self.index += 1
+        return response
+
+    @staticmethod
+    def _tokens(text: str) -> List[str]:
+        return re.findall(r"\S+\s*|\s+", text)
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"responses": len(self.responses)}
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings, no network involved.
+
+    Every word (or CJK character) is hashed into one of `size` dimensions,
+    so texts sharing words get similar vectors and search results are
+    stable between runs.
+    """
+
+    def __init__(self, size: int = 256):
+        self.size = size
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.size
+        for word in re.findall(r"[一-鿿]|\w+", text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.size] += 1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
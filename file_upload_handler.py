@@ -3,7 +3,8 @@ import shutil
 from typing import Tuple, Optional
 from werkzeug.utils import secure_filename
 import logging
-from document_processor import DocumentProcessor
+from document_processor import DEFAULT_COLLECTION, DocumentProcessor, validate_collection_name
+from metrics import timed
 from flask_socketio import SocketIO
 
 # 设置日志
@@ -71,13 +72,16 @@ class FileUploadHandler:
             logger.error(error_msg)
             return False, error_msg, None
 
-    def process_new_document(self, file_path: str, doc_processor: DocumentProcessor) -> Tuple[bool, str]:
+    @timed("upload_processing")
+    def process_new_document(self, file_path: str, doc_processor: DocumentProcessor,
+                             collection: str = DEFAULT_COLLECTION) -> Tuple[bool, str]:
         """
         处理新上传的文档
         
         Args:
             file_path: 文件路径
             doc_processor: DocumentProcessor 实例
+            collection: 文档所属的集合（索引分片）
             
         Returns:
             Tuple[bool, str]: (是否成功, 消息)
@@ -94,9 +98,9 @@ class FileUploadHandler:
             
             # 处理文档
             self._emit_progress(f"Processing document...")
-            doc_processor.process_documents(documents)
+            doc_processor.process_documents(documents, collection)
             
-            success_msg = f"Document processed successfully: {filename}"
+            success_msg = f"Document processed successfully: {filename} (collection '{collection}')"
             self._emit_progress(success_msg)
             return True, success_msg
             
@@ -106,17 +110,25 @@ class FileUploadHandler:
             self._emit_progress(f"Error: {error_msg}")
             return False, error_msg
 
-    def handle_upload(self, file, doc_processor: DocumentProcessor) -> Tuple[bool, str]:
+    def handle_upload(self, file, doc_processor: DocumentProcessor,
+                      collection: str = DEFAULT_COLLECTION) -> Tuple[bool, str]:
         """
         处理文件上传的完整流程
         
         Args:
             file: 上传的文件对象
             doc_processor: DocumentProcessor 实例
+            collection: 文档所属的集合（索引分片）
             
         Returns:
             Tuple[bool, str]: (是否成功, 消息)
         """
+        # 检查集合名称，避免保存文件后才失败
+        try:
+            validate_collection_name(collection)
+        except ValueError as e:
+            return False, str(e)
+
         # 保存文件
         success, message, file_path = self.save_file(file)
         if not success:
@@ -1,28 +1,103 @@
-from typing import List, Dict, Any
+import asyncio
+import contextvars
+import functools
+import json
+import re
+import threading
+import time
+from typing import List, Dict, Any, Optional, Sequence, Tuple
 from langchain_community.utilities import SQLDatabase
 from langchain_community.agent_toolkits import SQLDatabaseToolkit
 from langchain_openai import ChatOpenAI
 from langchain.tools import Tool
+from langchain_core.language_models import BaseLanguageModel
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from metrics import SQL_GUARD_DECISIONS, timed
 import logging
 
 logger = logging.getLogger(__name__)
 
+# statements and clauses that write, lock or change session state
+_WRITE_KEYWORDS = re.compile(
+    r"\b(insert|update|delete|merge|drop|alter|create|truncate|grant|revoke|copy|call|"
+    r"vacuum|reindex|lock|set|reset|refresh|listen|notify|into|execute|prepare)\b",
+    re.IGNORECASE
+)
+
+# materialized aggregate views over places and the columns they group by
+AGGREGATE_VIEWS: Dict[str, Tuple[str, ...]] = {
+    "places_by_country": ("adm0name", "adm0_a3"),
+    "places_by_province": ("adm0name", "adm1name"),
+    "places_by_feature": ("featurecla",),
+    "places_by_country_feature": ("adm0name", "featurecla"),
+}
+
+class QueryRejectedError(Exception):
+    """Raised when the query guard refuses to run a query.
+
+    `reason` is a short code ("not_read_only", "invalid_sql", "too_expensive"
+    or "timeout") and `suggestion` tells the caller how to write a query
+    that will be accepted.
+    """
+
+    SUGGESTIONS = {
+        "not_read_only": "Only a single SELECT (or WITH ... SELECT) statement is allowed.",
+        "invalid_sql": "Fix the error in the SQL and retry.",
+        "too_expensive": (
+            "Add selective WHERE filters (e.g. on adm0name or adm1name), avoid cross joins, "
+            "use ST_DWithin on geom instead of ST_DistanceSphere over the whole table, or aggregate."
+        ),
+        "timeout": "The query ran past the statement timeout; make it more selective or aggregate.",
+    }
+
+    def __init__(self, reason: str, detail: str, estimated_cost: Optional[float] = None,
+                 estimated_rows: Optional[float] = None):
+        super().__init__(f"{reason}: {detail}")
+        self.reason = reason
+        self.detail = detail
+        self.estimated_cost = estimated_cost
+        self.estimated_rows = estimated_rows
+        self.suggestion = self.SUGGESTIONS.get(reason, "")
+
+    def to_dict(self) -> Dict[str, Any]:
+        info = {"reason": self.reason, "detail": self.detail, "suggestion": self.suggestion}
+        if self.estimated_cost is not None:
+            info["estimated_cost"] = self.estimated_cost
+        if self.estimated_rows is not None:
+            info["estimated_rows"] = self.estimated_rows
+        return info
+
 class GeoDatabaseToolkit:
-    def __init__(self):
+    def __init__(self, engine: Optional[Engine] = None, llm: Optional[BaseLanguageModel] = None,
+                 async_engine: Optional[AsyncEngine] = None):
         load_dotenv()
         
-        # Initialize database connection
-        self.engine = self._create_engine()
+        # Limits of the guard in front of LLM-generated SQL
+        self.max_query_cost = float(os.getenv("SQL_MAX_COST", "1000000"))
+        self.max_query_rows = int(os.getenv("SQL_MAX_ROWS", "1000"))
+        self.statement_timeout_ms = int(os.getenv("SQL_STATEMENT_TIMEOUT_MS", "10000"))
+        
+        # whether the aggregate views exist; a negative answer is checked again after a minute
+        self._aggregate_views_ready = False
+        self._aggregate_views_checked_at: Optional[float] = None
+        
+        # Initialize database connection; unless given, the async engine is derived from
+        # the engine on the first async query
+        self.engine = engine or self._create_engine()
+        self._async_engine: Optional[AsyncEngine] = async_engine
+        self._async_engine_created = False
+        self._async_engine_lock = threading.Lock()
         
         # Initialize SQLDatabase
         self.db = SQLDatabase(engine=self.engine)
         
         # Initialize LLM
-        self.llm = ChatOpenAI(
+        self.llm = llm or ChatOpenAI(
             model="gpt-4-turbo-preview",
             temperature=0
         )
@@ -33,18 +108,48 @@ class GeoDatabaseToolkit:
         # Add custom tools
         self.tools = self._create_tools()
 
+    def _connection_string(self) -> str:
+        return (
+            f"postgresql://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@"
+            f"{os.getenv('POSTGRES_HOST')}:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}"
+        )
+
     def _create_engine(self) -> Engine:
         """create the database connection"""
         try:
-            connection_string = (
-                f"postgresql://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@"
-                f"{os.getenv('POSTGRES_HOST')}:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}"
-            )
-            return create_engine(connection_string)
+            return create_engine(self._connection_string())
         except Exception as e:
             logger.error(f"create database connection failed: {str(e)}")
             raise
 
+    @property
+    def async_engine(self) -> Optional[AsyncEngine]:
+        """the async engine used by the async query path, None when the database has no async driver"""
+        if self._async_engine is None and not self._async_engine_created:
+            with self._async_engine_lock:
+                if self._async_engine is None and not self._async_engine_created:
+                    self._async_engine = self._create_async_engine()
+                    self._async_engine_created = True
+        return self._async_engine
+
+    def _create_async_engine(self) -> Optional[AsyncEngine]:
+        """an asyncpg engine for the same PostgreSQL database as the sync engine"""
+        url = self.engine.url
+        if url.get_backend_name() != "postgresql":
+            logger.info(f"no async driver for {url.get_backend_name()}, async queries run in a thread")
+            return None
+        try:
+            return create_async_engine(url.set(drivername="postgresql+asyncpg"))
+        except Exception as e:
+            logger.error(f"create async database connection failed: {str(e)}")
+            raise
+
+    @staticmethod
+    async def _in_thread(fn, *args):
+        """run a blocking database call off the event loop, keeping the request trace"""
+        call = functools.partial(contextvars.copy_context().run, fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+
     def _create_tools(self) -> List[Tool]:
         """Create custom tools for geospatial queries."""
         base_tools = self.toolkit.get_tools()
@@ -70,30 +175,221 @@ class GeoDatabaseToolkit:
         
         return base_tools + custom_tools
 
-    def execute_query(self, sql: str) -> List[Dict[str, Any]]:
-        """execute the sql query and return the result"""
+    @staticmethod
+    def _rows_to_dicts(columns: Sequence[str], rows, raw: bool = False) -> List[Dict[str, Any]]:
+        # convert the result to a list of dictionaries, ensuring each value is serializable
+        # unless the caller asks for the driver's own types
+        if raw:
+            return [dict(zip(columns, row)) for row in rows]
+        return [dict(zip(columns, [str(val) if val is not None else None for val in row]))
+                for row in rows]
+
+    def _read_only_statements(self, dialect: str) -> Tuple[List[str], List[str]]:
+        """statements that make the current transaction read only, and undo it afterwards"""
+        if dialect == "postgresql":
+            # both end with the transaction, which is rolled back when the connection closes
+            return ["SET TRANSACTION READ ONLY",
+                    f"SET LOCAL statement_timeout = {self.statement_timeout_ms}"], []
+        if dialect == "sqlite":
+            return ["PRAGMA query_only = ON"], ["PRAGMA query_only = OFF"]
+        return [], []
+
+    def _timeout_error(self, e: DBAPIError) -> Optional[QueryRejectedError]:
+        if "statement timeout" in str(e.orig) or "canceling statement" in str(e.orig):
+            return QueryRejectedError("timeout", f"exceeded {self.statement_timeout_ms} ms")
+        return None
+
+    @timed("execute_query")
+    def execute_query(self, sql: str, raw: bool = False, read_only: bool = False) -> List[Dict[str, Any]]:
+        """execute the sql query and return the result, with values as strings unless raw
+
+        read_only runs the query in a read-only transaction with a statement timeout
+        """
+        return self._execute(sql, raw, read_only)
+
+    def _execute(self, sql: str, raw: bool, read_only: bool) -> List[Dict[str, Any]]:
         try:
             with self.engine.connect() as connection:
-                result = connection.execute(text(sql))
-                # get the column names
-                columns = result.keys()
-                # convert the result to a list of dictionaries, ensuring each value is serializable
-                return [dict(zip(columns, [str(val) if val is not None else None for val in row])) 
-                       for row in result]
+                enter, leave = self._read_only_statements(connection.dialect.name) if read_only else ([], [])
+                for statement in enter:
+                    connection.execute(text(statement))
+                try:
+                    result = connection.execute(text(sql))
+                    # get the column names
+                    columns = list(result.keys())
+                    return self._rows_to_dicts(columns, result, raw)
+                finally:
+                    for statement in leave:
+                        connection.execute(text(statement))
+        except DBAPIError as e:
+            logger.error(f"execute query failed: {str(e)}")
+            timeout = self._timeout_error(e) if read_only else None
+            if timeout is not None:
+                raise timeout from e
+            raise
+        except Exception as e:
+            logger.error(f"execute query failed: {str(e)}")
+            raise
+
+    @timed("execute_query")
+    async def aexecute_query(self, sql: str, raw: bool = False, read_only: bool = False) -> List[Dict[str, Any]]:
+        """execute the sql query without blocking the event loop"""
+        if self.async_engine is None:
+            return await self._in_thread(self._execute, sql, raw, read_only)
+        try:
+            async with self.async_engine.connect() as connection:
+                enter, leave = self._read_only_statements(connection.dialect.name) if read_only else ([], [])
+                for statement in enter:
+                    await connection.execute(text(statement))
+                try:
+                    result = await connection.execute(text(sql))
+                    columns = list(result.keys())
+                    return self._rows_to_dicts(columns, result.fetchall(), raw)
+                finally:
+                    for statement in leave:
+                        await connection.execute(text(statement))
+        except DBAPIError as e:
+            logger.error(f"execute query failed: {str(e)}")
+            timeout = self._timeout_error(e) if read_only else None
+            if timeout is not None:
+                raise timeout from e
+            raise
         except Exception as e:
             logger.error(f"execute query failed: {str(e)}")
             raise
 
+    @staticmethod
+    def check_read_only(sql: str) -> str:
+        """return the statement without comments and trailing semicolon, or raise if it is not a single SELECT"""
+        # drop comments so the query can be wrapped safely, keeping string literals intact
+        sql = re.sub(r"'(?:[^']|'')*'|--[^\n]*|/\*.*?\*/",
+                     lambda m: m.group(0) if m.group(0).startswith("'") else " ", sql, flags=re.DOTALL)
+        sql = sql.strip().rstrip(";").strip()
+        # string literals may contain anything, ignore them
+        body = re.sub(r"'(?:[^']|'')*'", "''", sql)
+        if not body:
+            raise QueryRejectedError("invalid_sql", "empty query")
+        if ";" in body:
+            raise QueryRejectedError("not_read_only", "multiple statements")
+        first = body.split(None, 1)[0].lower()
+        if first not in ("select", "with"):
+            raise QueryRejectedError("not_read_only", f"{first.upper()} statements are not allowed")
+        keyword = _WRITE_KEYWORDS.search(body)
+        if keyword:
+            raise QueryRejectedError("not_read_only", f"{keyword.group(1).upper()} is not allowed in a read-only query")
+        return sql
+
+    @staticmethod
+    def _plan_estimates(value: Any) -> Tuple[float, float]:
+        """total cost and row estimate of the top node of an EXPLAIN (FORMAT JSON) result"""
+        plan = json.loads(value) if isinstance(value, str) else value
+        top = plan[0]["Plan"]
+        return float(top["Total Cost"]), float(top["Plan Rows"])
+
+    def _limited(self, sql: str) -> str:
+        return f"SELECT * FROM ({sql}) AS limited_result LIMIT {self.max_query_rows}"
+
+    def _check_estimates(self, cost: float, rows: float):
+        if cost > self.max_query_cost:
+            raise QueryRejectedError(
+                "too_expensive",
+                f"estimated cost {cost:.0f} exceeds the limit of {self.max_query_cost:.0f}",
+                estimated_cost=cost, estimated_rows=rows
+            )
+
+    def _limit_note(self, rows: float) -> str:
+        logger.info(f"query limited to {self.max_query_rows} rows, {rows:.0f} rows estimated")
+        return (f"Note: the query was estimated to return {rows:.0f} rows, "
+                f"so only the first {self.max_query_rows} are returned.")
+
+    def guard_query(self, sql: str) -> Tuple[str, Optional[str]]:
+        """check LLM-generated SQL before it runs
+
+        Rejects anything but a single read-only SELECT, and uses EXPLAIN to
+        reject queries estimated to cost more than SQL_MAX_COST. Queries
+        estimated to return more than SQL_MAX_ROWS rows are wrapped in a LIMIT
+        first, which is often enough to bring the cost down. Returns the SQL to
+        run and, when it was rewritten, a note for the caller.
+        """
+        try:
+            sql = self.check_read_only(sql)
+            note = None
+            # cost estimates come from the PostgreSQL planner, other databases only get the read-only check
+            if self.engine.dialect.name == "postgresql":
+                cost, rows = self._explain(sql)
+                if rows > self.max_query_rows:
+                    sql, note = self._limited(sql), self._limit_note(rows)
+                    cost, _ = self._explain(sql)
+                self._check_estimates(cost, rows)
+        except QueryRejectedError:
+            SQL_GUARD_DECISIONS.labels(decision="rejected").inc()
+            raise
+        SQL_GUARD_DECISIONS.labels(decision="limited" if note else "passed").inc()
+        return sql, note
+
+    async def aguard_query(self, sql: str) -> Tuple[str, Optional[str]]:
+        """check LLM-generated SQL before it runs, using the async driver for EXPLAIN"""
+        try:
+            sql = self.check_read_only(sql)
+            note = None
+            if self.engine.dialect.name == "postgresql":
+                cost, rows = await self._aexplain(sql)
+                if rows > self.max_query_rows:
+                    sql, note = self._limited(sql), self._limit_note(rows)
+                    cost, _ = await self._aexplain(sql)
+                self._check_estimates(cost, rows)
+        except QueryRejectedError:
+            SQL_GUARD_DECISIONS.labels(decision="rejected").inc()
+            raise
+        SQL_GUARD_DECISIONS.labels(decision="limited" if note else "passed").inc()
+        return sql, note
+
+    def _explain(self, sql: str) -> Tuple[float, float]:
+        try:
+            with self.engine.connect() as connection:
+                return self._plan_estimates(connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar())
+        except DBAPIError as e:
+            raise QueryRejectedError("invalid_sql", str(e.orig).strip().splitlines()[0]) from e
+
+    async def _aexplain(self, sql: str) -> Tuple[float, float]:
+        if self.async_engine is None:
+            return await self._in_thread(self._explain, sql)
+        try:
+            async with self.async_engine.connect() as connection:
+                result = await connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"))
+                return self._plan_estimates(result.scalar())
+        except DBAPIError as e:
+            raise QueryRejectedError("invalid_sql", str(e.orig).strip().splitlines()[0]) from e
+
+    async def adispose(self):
+        """close the connections of the async engine created by the toolkit"""
+        if self._async_engine is not None and self._async_engine_created:
+            await self._async_engine.dispose()
+            self._async_engine = None
+            self._async_engine_created = False
+
+    @staticmethod
+    def _quote(value: Any) -> str:
+        """escape a value for use inside a single-quoted SQL literal"""
+        return str(value).replace("'", "''")
+
     def find_nearby_places(self, place_name: str, distance_km: float) -> str:
         """find the places within a certain distance of a point"""
+        place_name = self._quote(place_name)
         return f"""
         SELECT name, name_en, name_zh, latitude, longitude, pop_max, adm0name, adm1name
         FROM places
-        WHERE ST_DistanceSphere(geom, (SELECT geom FROM places WHERE name_en = '{place_name}')) <= {distance_km * 1000};
+        WHERE ST_DistanceSphere(geom, (
+            SELECT geom FROM places
+            WHERE name = '{place_name}' OR name_en = '{place_name}' OR name_zh = '{place_name}'
+            ORDER BY pop_max DESC NULLS LAST
+            LIMIT 1
+        )) <= {float(distance_km) * 1000};
         """
 
     def search_places_by_name(self, name: str) -> str:
         """search the places by name in multiple languages"""
+        name = self._quote(name)
         return f"""
         SELECT name, name_en, name_zh, latitude, longitude, pop_max, adm0name, adm1name
         FROM places
@@ -102,16 +398,128 @@ class GeoDatabaseToolkit:
 
     def get_place_details(self, place_name: str) -> str:
         """get the detailed information about a specific place"""
+        place_name = self._quote(place_name)
         return f"""
         SELECT name, name_en, name_zh, latitude, longitude, pop_max, adm0name, adm1name
         FROM places
         WHERE name = '{place_name}' OR name_en = '{place_name}' OR name_zh = '{place_name}';
         """
 
+    def top_places_by_population(self, country: str, limit: int = 10) -> str:
+        """get the most populous places of a country"""
+        country = self._quote(country)
+        return f"""
+        SELECT name, name_en, name_zh, latitude, longitude, pop_max, adm0name, adm1name
+        FROM places
+        WHERE adm0name ILIKE '{country}' OR adm0_a3 = UPPER('{country}')
+        ORDER BY pop_max DESC NULLS LAST
+        LIMIT {int(limit)};
+        """
+
     def get_tools(self) -> List[Tool]:
         """Get all available tools."""
         return self.tools
 
+    @staticmethod
+    def _aggregate_select(group_by: Sequence[str]) -> str:
+        """per-group counts, population totals and the most populous place"""
+        columns = ", ".join(group_by)
+        # ROW_NUMBER instead of array_agg so the same SQL runs on the SQLite stand-in
+        return f"""
+        SELECT {columns},
+               COUNT(*) AS place_count,
+               SUM(pop_max) AS total_population,
+               MAX(pop_max) AS max_population,
+               MAX(CASE WHEN population_rank = 1 THEN name END) AS largest_place
+        FROM (
+            SELECT {columns}, name, pop_max,
+                   ROW_NUMBER() OVER (PARTITION BY {columns} ORDER BY pop_max IS NULL, pop_max DESC) AS population_rank
+            FROM places
+        ) ranked
+        GROUP BY {columns}
+        """
+
+    def create_aggregate_views(self) -> List[str]:
+        """create the aggregate views that do not exist yet
+
+        PostgreSQL gets materialized views with a unique index so they can be
+        refreshed concurrently; other databases get plain tables built from
+        the same query.
+        """
+        created = []
+        with self.engine.begin() as connection:
+            postgres = connection.dialect.name == "postgresql"
+            existing = self._existing_aggregate_views(connection)
+            for name, group_by in AGGREGATE_VIEWS.items():
+                if name in existing:
+                    continue
+                if postgres:
+                    connection.execute(text(f"CREATE MATERIALIZED VIEW {name} AS {self._aggregate_select(group_by)}"))
+                    connection.execute(text(f"CREATE UNIQUE INDEX {name}_key ON {name} ({', '.join(group_by)})"))
+                else:
+                    connection.execute(text(f"CREATE TABLE {name} AS {self._aggregate_select(group_by)}"))
+                created.append(name)
+        self._aggregate_views_ready = True
+        logger.info(f"created aggregate views: {', '.join(created) or 'none, all exist'}")
+        return created
+
+    def refresh_aggregate_views(self, concurrently: bool = True,
+                                names: Optional[Sequence[str]] = None) -> Dict[str, float]:
+        """recompute the aggregate views (all by default) and return the seconds each took
+
+        concurrently keeps a PostgreSQL view readable while it is refreshed
+        """
+        timings = {}
+        for name in names if names is not None else AGGREGATE_VIEWS:
+            group_by = AGGREGATE_VIEWS[name]
+            start = time.perf_counter()
+            with self.engine.begin() as connection:
+                if connection.dialect.name == "postgresql":
+                    mode = "CONCURRENTLY " if concurrently else ""
+                    connection.execute(text(f"REFRESH MATERIALIZED VIEW {mode}{name}"))
+                else:
+                    connection.execute(text(f"DELETE FROM {name}"))
+                    connection.execute(text(f"INSERT INTO {name} {self._aggregate_select(group_by)}"))
+            timings[name] = time.perf_counter() - start
+            logger.info(f"refreshed {name} in {timings[name] * 1000:.1f} ms")
+        return timings
+
+    @staticmethod
+    def _existing_aggregate_views(connection) -> set:
+        inspector = inspect(connection)
+        if connection.dialect.name == "postgresql":
+            names = set(inspector.get_materialized_view_names())
+        else:
+            names = set(inspector.get_table_names())
+        return names & set(AGGREGATE_VIEWS)
+
+    def aggregate_views_available(self) -> bool:
+        """whether all aggregate views exist, cached once they do"""
+        now = time.monotonic()
+        if not self._aggregate_views_ready and (self._aggregate_views_checked_at is None
+                                                or now - self._aggregate_views_checked_at > 60):
+            self._aggregate_views_checked_at = now
+            try:
+                with self.engine.connect() as connection:
+                    self._aggregate_views_ready = self._existing_aggregate_views(connection) == set(AGGREGATE_VIEWS)
+            except Exception as e:
+                logger.warning(f"could not check the aggregate views: {str(e)}")
+                self._aggregate_views_ready = False
+        return self._aggregate_views_ready
+
+    def describe_aggregate_views(self) -> str:
+        """prompt text describing the aggregate views, empty when they do not exist"""
+        if not self.aggregate_views_available():
+            return ""
+        lines = []
+        for name, group_by in AGGREGATE_VIEWS.items():
+            lines.append(
+                f"- public.{name}: one row per {' and '.join(group_by)}; columns {', '.join(group_by)}, "
+                "place_count, total_population (sum of pop_max), max_population, "
+                "largest_place (name of the place with the highest pop_max)."
+            )
+        return "\n".join(lines)
+
     def get_table_info(self) -> str:
         """Get information about the database tables."""
         return self.db.get_table_info() 
\ No newline at end of file
@@ -1,72 +1,194 @@
+import asyncio
+import json
+import contextvars
 import os
-from typing import List, Dict, Any
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
 from langchain.agents import AgentExecutor, create_openai_tools_agent
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.tools import Tool
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from agent_callbacks import GENERATED_SQL_MARKER, TokenStreamHandler
 from document_processor import DocumentProcessor
-from geo_db_toolkit import GeoDatabaseToolkit
-from langchain.memory import ConversationBufferMemory
+from geo_db_toolkit import GeoDatabaseToolkit, QueryRejectedError
+from conversation_memory import TokenBudgetMemory
+from context_compression import ContextCompressor
+from intent_router import IntentRouter
+from metrics import LLMMetricsHandler, current_trace, observe
+from profiling import profiled
+from result_formatter import ResultFormatter
 import logging
 
 logger = logging.getLogger(__name__)
 
+# parallel tool traces of the query being answered, set by GeoRAGAgent._run/arun
+_parallel_traces: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar(
+    "parallel_traces", default=None
+)
+# columnar SQL results of the query being answered, for the web client
+_sql_tables: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar(
+    "sql_tables", default=None
+)
+# document collections the query searches, None for all of them
+_search_collections: contextvars.ContextVar[Optional[List[str]]] = contextvars.ContextVar(
+    "search_collections", default=None
+)
+
 class GeoRAGAgent:
-    def __init__(self):
+    def __init__(self, llm: Optional[BaseChatModel] = None,
+                 doc_processor: Optional[DocumentProcessor] = None,
+                 db_toolkit: Optional[GeoDatabaseToolkit] = None):
         load_dotenv()
         
-        # Initialize OpenAI
-        self.llm = ChatOpenAI(
+        # Initialize OpenAI; streaming lets stream() forward answer tokens as they arrive
+        self.llm = llm or ChatOpenAI(
             model="gpt-4-turbo-preview",
-            temperature=0
+            temperature=0,
+            streaming=True
         )
+        # records the latency and token counts of every LLM call on /metrics
+        self.llm_metrics = LLMMetricsHandler()
         
         # Initialize document processor with FAISS
-        self.doc_processor = DocumentProcessor(openai_api_key=os.getenv("OPENAI_API_KEY"))
-        
-        # Try to load existing vector store
-        self.doc_processor.load_vectorstore()
+        if doc_processor is None:
+            doc_processor = DocumentProcessor(openai_api_key=os.getenv("OPENAI_API_KEY"))
+            # Try to load the existing index shards of all collections
+            doc_processor.load_vectorstores()
+        self.doc_processor = doc_processor
         
         # Initialize database toolkit
-        self.db_toolkit = GeoDatabaseToolkit()
+        self.db_toolkit = db_toolkit or GeoDatabaseToolkit()
+        
+        # Retrieval over-fetches candidates, diversifies them with MMR, then the
+        # compressor deduplicates, merges and packs them into a token budget
+        self.retrieval_options = {
+            "k": int(os.getenv("RETRIEVAL_K", "8")),
+            "fetch_k": int(os.getenv("RETRIEVAL_FETCH_K", "20")),
+            "lambda_mult": float(os.getenv("RETRIEVAL_MMR_LAMBDA", "0.5")),
+        }
+        self.context_compressor = ContextCompressor(
+            token_budget=int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "800")),
+            dedup_threshold=float(os.getenv("RETRIEVAL_DEDUP_THRESHOLD", "0.8"))
+        )
+        
+        # Threads for tools whose independent parts run concurrently
+        self._tool_pool = ThreadPoolExecutor(
+            max_workers=int(os.getenv("TOOL_MAX_WORKERS", "8")),
+            thread_name_prefix="geo-tool"
+        )
+        
+        # Compact, token-capped rendering of SQL results in prompts
+        self.result_formatter = ResultFormatter()
         
         # Create tools
         self.tools = self._create_tools()
         
-        # Initialize memory
-        self.memory = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True
-        )
+        # Deterministic fast path for common questions, FAST_PATH_ENABLED=false disables it
+        self.router = None
+        if os.getenv("FAST_PATH_ENABLED", "true").lower() == "true":
+            self.router = IntentRouter(self.db_toolkit, self._format_sql_results)
+        
+        # Initialize memory; every session gets its own conversation history, callers
+        # without a session id get none. Sessions are kept in least recently used
+        # order; idle or surplus ones are evicted.
+        self.session_memories: "OrderedDict[str, Tuple[TokenBudgetMemory, float]]" = OrderedDict()
+        self.max_sessions = int(os.getenv("MEMORY_MAX_SESSIONS", "1000"))
+        self.session_idle_seconds = float(os.getenv("MEMORY_SESSION_IDLE_SECONDS", "3600"))
+        self._session_lock = threading.Lock()
+        self._background_tasks: set = set()
         
         # Create agent
         self.agent_executor = self._create_agent()
 
+    def _create_memory(self) -> TokenBudgetMemory:
+        """Create an empty conversation memory with a hard token budget."""
+        return TokenBudgetMemory(
+            memory_key="chat_history",
+            return_messages=True,
+            max_token_limit=int(os.getenv("MEMORY_MAX_TOKENS", "2000")),
+            max_message_tokens=int(os.getenv("MEMORY_MAX_MESSAGE_TOKENS", "300")),
+            # older turns are summarized by the LLM, or dropped when MEMORY_SUMMARIZE=false
+            llm=self.llm if os.getenv("MEMORY_SUMMARIZE", "true").lower() == "true" else None
+        )
+
+    def get_memory(self, session_id: Optional[str] = None) -> TokenBudgetMemory:
+        """Get the conversation memory of a session, creating it on first use.
+
+        Without a session id an empty throwaway memory is returned, so anonymous
+        callers never see each other's history.
+        """
+        if session_id is None:
+            return self._create_memory()
+        now = time.monotonic()
+        with self._session_lock:
+            memory, _ = self.session_memories.pop(session_id, (None, None))
+            if memory is None:
+                memory = self._create_memory()
+            self.session_memories[session_id] = (memory, now)
+            self._evict_sessions(now)
+            return memory
+
+    def _evict_sessions(self, now: float):
+        # the oldest entries come first, stop at the first one that may stay
+        while self.session_memories:
+            session_id, (_, last_used) = next(iter(self.session_memories.items()))
+            if len(self.session_memories) <= self.max_sessions and now - last_used <= self.session_idle_seconds:
+                break
+            del self.session_memories[session_id]
+            logger.info(f"evicted conversation memory of session {session_id}")
+
+    def clear_session(self, session_id: str):
+        """Drop the conversation history of a session."""
+        with self._session_lock:
+            self.session_memories.pop(session_id, None)
+
     def _create_tools(self) -> List[Tool]:
         """Create the tools for the agent."""
         # RAG Tool for document search
         rag_tool = Tool(
             name="Document_Search",
             description="Search for relevant information in documents using semantic search",
-            func=self._search_documents
+            func=self._search_documents,
+            coroutine=self._asearch_documents
         )
         
         # SQL Generation Tool
         sql_tool = Tool(
             name="Generate_SQL",
             description="Generate SQL query based on natural language input",
-            func=self._generate_sql
+            func=self._generate_sql,
+            coroutine=self._agenerate_sql
         )
         
         # Database Execution Tool
         db_tool = Tool(
             name="Execute_SQL",
-            description="Execute SQL query on the database",
-            func=self._execute_sql
+            description=(
+                "Execute a read-only SELECT query on the database. Queries the planner estimates to be too "
+                "expensive are rejected with a JSON reason and suggestion; rewrite them and retry"
+            ),
+            func=self._execute_sql,
+            coroutine=self._aexecute_sql
         )
         
-        return [rag_tool, sql_tool, db_tool]
+        # Document search and SQL generation do not depend on each other, run them together
+        parallel_tool = Tool(
+            name="Search_And_Generate_SQL",
+            description="Search documents for context and generate the SQL query at the same time. "
+                        "Prefer this over calling Document_Search and Generate_SQL one after another",
+            func=self._search_and_generate_sql,
+            coroutine=self._asearch_and_generate_sql
+        )
+        
+        return [rag_tool, sql_tool, db_tool, parallel_tool]
 
     def _create_agent(self) -> AgentExecutor:
         """Create the agent executor."""
@@ -92,9 +214,10 @@ class GeoRAGAgent:
             4. Use parameterized queries when possible
             
             Always follow this process:
-            1. First, search documents for relevant context
-            2. Then, generate the appropriate SQL query
-            3. Finally, execute the query and return results
+            1. Search documents for relevant context and generate the appropriate SQL query.
+               These two steps are independent: use Search_And_Generate_SQL to run them together,
+               or call Document_Search and Generate_SQL in the same step (several tool calls at once)
+            2. Then, execute the query and return results
             
             For spatial queries, use these common patterns:
             - Distance queries: ST_DistanceSphere(geom, (SELECT geom FROM places WHERE name_en = 'City'))
@@ -107,130 +230,417 @@ class GeoRAGAgent:
         ])
 
         agent = create_openai_tools_agent(self.llm, self.tools, prompt)
+        # memory is not attached to the executor: it is shared by all sessions,
+        # so run() loads and saves the history of the calling session itself
         return AgentExecutor(
             agent=agent,
             tools=self.tools,
-            memory=self.memory,
             verbose=True
         )
 
     def _search_documents(self, query: str) -> str:
         """Search for relevant documents using FAISS."""
         try:
-            results = self.doc_processor.search_documents(query)
-            formatted_results = []
-            for result in results:
-                formatted_results.append(
-                    f"Content: {result['content']}\n"
-                    f"Source: {result['metadata'].get('source', 'Unknown')}\n"
-                )
-            return "\n".join(formatted_results)
+            results = self.doc_processor.mmr_search_documents(
+                query, collections=_search_collections.get(), **self.retrieval_options
+            )
+            return self.context_compressor.compress(results)[0]
+        except ValueError as e:
+            return str(e)
+
+    async def _asearch_documents(self, query: str) -> str:
+        """Search for relevant documents without blocking the event loop."""
+        try:
+            results = await self.doc_processor.ammr_search_documents(
+                query, collections=_search_collections.get(), **self.retrieval_options
+            )
+            return self.context_compressor.compress(results)[0]
         except ValueError as e:
             return str(e)
 
+    def _sql_prompt(self, query: str) -> str:
+        """Build the SQL generation prompt for the public.places table and its aggregate views."""
+        views = self.db_toolkit.describe_aggregate_views()
+        if views:
+            views = "\n".join("        " + line for line in views.splitlines())
+            views = f"""
+        Precomputed Aggregate Views (materialized from public.places and refreshed periodically):
+{views}
+        For counts, population totals or the largest place per country, province (adm1name) or feature class,
+        query these views instead of running GROUP BY over public.places; filter and join them like tables.
+"""
+        return f"""
+        You are an expert SQL query generator, specializing in PostgreSQL with the PostGIS extension.
+        Your task is to convert natural language questions into precise SQL queries for a table named "public.places".
+
+        Table Description:
+        The "public.places" table contains information about populated places around the world,
+        including names, administrative hierarchy, geographic coordinates, population data,
+        timezones, and other relevant attributes. The geometry is stored using PostGIS.
+
+        Table Schema "public.places":
+        - gid (integer, primary key): Unique identifier for each place.
+        - name (text, up to 100 chars): Common name of the place.
+        - nameascii (text, up to 100 chars): ASCII version of the name.
+        - name_en (text, up to 100 chars): English name.
+        - name_zh (text, up to 100 chars): Simplified Chinese name.
+        - name_zht (text, up to 80 chars): Traditional Chinese name.
+        - (Include other relevant name_xx columns if frequently queried, e.g., name_es, name_fr)
+        - featurecla (text, up to 50 chars): Feature classification (e.g., 'Admin-0 capital', 'Populated place', 'Port', 'Airport').
+        - scalerank (smallint): Scale rank for map display (lower means more important, shown earlier).
+        - labelrank (smallint): Label display rank (lower means higher priority).
+        - adm0name (text, up to 50 chars): Sovereign country name where the place is located. (e.g., 'China', 'United States')
+        - adm0_a3 (text, 3 chars): ISO 3166-1 alpha-3 country code for adm0name. (e.g., 'CHN', 'USA')
+        - adm1name (text, up to 100 chars): Name of the first-level administrative unit (e.g., province, state). (e.g., 'Shanghai Shi', 'Illinois')
+        - latitude (float/double precision): Latitude in decimal degrees (WGS84).
+        - longitude (float/double precision): Longitude in decimal degrees (WGS84).
+        - pop_max (float/double precision): Maximum recorded population (numeric, number of persons).
+        - pop_min (float/double precision): Minimum recorded population (numeric, number of persons).
+        - (Include other popYYYY columns if historical/projected population queries are needed, e.g., pop2000, pop2025)
+        - timezone (text, up to 50 chars): Olson timezone name (e.g., 'Asia/Shanghai', 'America/Chicago').
+        - wikidataid (text, up to 30 chars): Wikidata entity ID.
+        - geom (geometry(Point, 4326)): PostGIS point geometry representing the location. SRID is 4326 (WGS84, latitude/longitude).
+{views}
+        Query Generation Guidelines:
+        1.  Always refer to the table as "public.places".
+        2.  Use ONLY the columns listed above. If a question implies a column not listed, state that the information is not available or make a best guess based on related columns.
+        3.  For spatial queries involving latitude and longitude from user input, construct a PostGIS point using `ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)`.
+        4.  When comparing with the "geom" column, use appropriate PostGIS functions like:
+            - `ST_DWithin(geom1, geom2, distance_meters)`: For finding places within a certain distance (ensure `geom1` and `geom2` are cast to `geography` for meter-based distance, e.g., `ST_DWithin(places.geom::geography, ST_SetSRID(ST_MakePoint(lon, lat), 4326)::geography, radius_meters)`).
+            - `ST_Distance(geom1::geography, geom2::geography)`: To calculate distance in meters.
+            - `ST_Contains(polygon_geom, places.geom)`: To find places within a given polygon.
+            - `ST_Intersects(geom1, geom2)`: To check for intersection.
+        5.  When filtering by place names (name, name_en, name_zh, etc.), use `ILIKE` for case-insensitive matching if appropriate, e.g., `name_en ILIKE '%New York%'`.
+        6.  Handle potential NULL values explicitly if the query logic depends on it (e.g., `WHERE column_name IS NOT NULL` or `COALESCE(column_name, default_value)`). However, for simple selections, filtering out NULLs is often implied if not specified.
+        7.  If the question asks for something like "capital city", use the `featurecla` column (e.g., `featurecla LIKE 'Admin-0 capital%'`) or `adm0cap = 1`.
+        8.  If a specific number of results is requested (e.g., "top 5"), use `LIMIT`. If ordering is implied, use `ORDER BY` (e.g., by `pop_max DESC` for most populated).
+        9.  The generated SQL should be a single, complete, and executable PostgreSQL statement.
+        10. you should extremly catious about the unit of the distance, you should convert the unit to meters if the user input is in kilometers or miles.
+
+        Generate ONLY the SQL query based on the following question. Do not include any explanations, comments, markdown, or any text other than the SQL query itself.
+
+        Question: {query}
+
+        SQL Query:
+        """
+
+    @staticmethod
+    def _clean_sql(text: str) -> str:
+        """Strip markdown fences the model may wrap around the SQL."""
+        sql = text.strip()
+        if sql.startswith("```"):
+            sql = sql.split("\n", 1)[1] if "\n" in sql else ""
+            sql = sql.rsplit("```", 1)[0]
+        return sql.strip()
+
     def _generate_sql(self, query: str) -> str:
         """Generate SQL query based on natural language input for the public.places table."""
         try:
             # 使用 LLM 生成 SQL
             # 注意：在实际应用中，为了防止SQL注入，应该对 query 进行清理或使用参数化查询，
             # 但这里假设 LLM 生成的 SQL 会被进一步审查或在安全的环境中执行。
-            prompt = f"""
-            You are an expert SQL query generator, specializing in PostgreSQL with the PostGIS extension.
-            Your task is to convert natural language questions into precise SQL queries for a table named "public.places".
-
-            Table Description:
-            The "public.places" table contains information about populated places around the world,
-            including names, administrative hierarchy, geographic coordinates, population data,
-            timezones, and other relevant attributes. The geometry is stored using PostGIS.
-
-            Table Schema "public.places":
-            - gid (integer, primary key): Unique identifier for each place.
-            - name (text, up to 100 chars): Common name of the place.
-            - nameascii (text, up to 100 chars): ASCII version of the name.
-            - name_en (text, up to 100 chars): English name.
-            - name_zh (text, up to 100 chars): Simplified Chinese name.
-            - name_zht (text, up to 80 chars): Traditional Chinese name.
-            - (Include other relevant name_xx columns if frequently queried, e.g., name_es, name_fr)
-            - featurecla (text, up to 50 chars): Feature classification (e.g., 'Admin-0 capital', 'Populated place', 'Port', 'Airport').
-            - scalerank (smallint): Scale rank for map display (lower means more important, shown earlier).
-            - labelrank (smallint): Label display rank (lower means higher priority).
-            - adm0name (text, up to 50 chars): Sovereign country name where the place is located. (e.g., 'China', 'United States')
-            - adm0_a3 (text, 3 chars): ISO 3166-1 alpha-3 country code for adm0name. (e.g., 'CHN', 'USA')
-            - adm1name (text, up to 100 chars): Name of the first-level administrative unit (e.g., province, state). (e.g., 'Shanghai Shi', 'Illinois')
-            - latitude (float/double precision): Latitude in decimal degrees (WGS84).
-            - longitude (float/double precision): Longitude in decimal degrees (WGS84).
-            - pop_max (float/double precision): Maximum recorded population (numeric, number of persons).
-            - pop_min (float/double precision): Minimum recorded population (numeric, number of persons).
-            - (Include other popYYYY columns if historical/projected population queries are needed, e.g., pop2000, pop2025)
-            - timezone (text, up to 50 chars): Olson timezone name (e.g., 'Asia/Shanghai', 'America/Chicago').
-            - wikidataid (text, up to 30 chars): Wikidata entity ID.
-            - geom (geometry(Point, 4326)): PostGIS point geometry representing the location. SRID is 4326 (WGS84, latitude/longitude).
-
-            Query Generation Guidelines:
-            1.  Always refer to the table as "public.places".
-            2.  Use ONLY the columns listed above. If a question implies a column not listed, state that the information is not available or make a best guess based on related columns.
-            3.  For spatial queries involving latitude and longitude from user input, construct a PostGIS point using `ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)`.
-            4.  When comparing with the "geom" column, use appropriate PostGIS functions like:
-                - `ST_DWithin(geom1, geom2, distance_meters)`: For finding places within a certain distance (ensure `geom1` and `geom2` are cast to `geography` for meter-based distance, e.g., `ST_DWithin(places.geom::geography, ST_SetSRID(ST_MakePoint(lon, lat), 4326)::geography, radius_meters)`).
-                - `ST_Distance(geom1::geography, geom2::geography)`: To calculate distance in meters.
-                - `ST_Contains(polygon_geom, places.geom)`: To find places within a given polygon.
-                - `ST_Intersects(geom1, geom2)`: To check for intersection.
-            5.  When filtering by place names (name, name_en, name_zh, etc.), use `ILIKE` for case-insensitive matching if appropriate, e.g., `name_en ILIKE '%New York%'`.
-            6.  Handle potential NULL values explicitly if the query logic depends on it (e.g., `WHERE column_name IS NOT NULL` or `COALESCE(column_name, default_value)`). However, for simple selections, filtering out NULLs is often implied if not specified.
-            7.  If the question asks for something like "capital city", use the `featurecla` column (e.g., `featurecla LIKE 'Admin-0 capital%'`) or `adm0cap = 1`.
-            8.  If a specific number of results is requested (e.g., "top 5"), use `LIMIT`. If ordering is implied, use `ORDER BY` (e.g., by `pop_max DESC` for most populated).
-            9.  The generated SQL should be a single, complete, and executable PostgreSQL statement.
-            10. you should extremly catious about the unit of the distance, you should convert the unit to meters if the user input is in kilometers or miles.
-
-            Generate ONLY the SQL query based on the following question. Do not include any explanations, comments, markdown, or any text other than the SQL query itself.
-
-            Question: {query}
-
-            SQL Query:
-            """
-            # ... (LLM call and result processing) ...
-            # For example:
-            # response = call_llm_service(prompt)
-            # sql_query = response.text.strip()
-            # return sql_query
-
+            response = self.llm.invoke(self._sql_prompt(query), config={"callbacks": [self.llm_metrics]})
+            return self._clean_sql(str(response.content))
         except Exception as e:
             # Log the error appropriately
-            print(f"Error generating SQL: {e}")
+            logger.error(f"Error generating SQL: {e}")
             # Depending on requirements, you might raise the error,
             # return a default/error SQL, or return an error message.
             return "SELECT 'Error generating SQL query due to an internal issue.';"
 
+    async def _agenerate_sql(self, query: str) -> str:
+        """Generate SQL query with the async LLM client."""
+        try:
+            response = await self.llm.ainvoke(self._sql_prompt(query), config={"callbacks": [self.llm_metrics]})
+            return self._clean_sql(str(response.content))
+        except Exception as e:
+            logger.error(f"Error generating SQL: {e}")
+            return "SELECT 'Error generating SQL query due to an internal issue.';"
+
+    @staticmethod
+    def _record_parallel_trace(tool: str, durations: Dict[str, float], wall: float):
+        """Record how much wall-clock time running the branches together saved."""
+        trace = {
+            "tool": tool,
+            "branches_ms": {name: round(d * 1000, 1) for name, d in durations.items()},
+            "wall_ms": round(wall * 1000, 1),
+            "saved_ms": round(max(sum(durations.values()) - wall, 0.0) * 1000, 1),
+        }
+        logger.info(f"parallel tool trace: {trace}")
+        traces = _parallel_traces.get()
+        if traces is not None:
+            traces.append(trace)
+
+    @staticmethod
+    def _format_search_and_sql(context: str, sql: str) -> str:
+        return f"Document context:\n{context}\n\n{GENERATED_SQL_MARKER}{sql}"
+
+    def _search_and_generate_sql(self, query: str) -> str:
+        """Run Document_Search and Generate_SQL concurrently on the tool pool."""
+        def measure(fn):
+            start = time.perf_counter()
+            with profiled():
+                result = fn(query)
+            return result, time.perf_counter() - start
+
+        # each branch runs in a copy of this context so stage timings reach the request trace
+        start = time.perf_counter()
+        search = self._tool_pool.submit(contextvars.copy_context().run, measure, self._search_documents)
+        sql = self._tool_pool.submit(contextvars.copy_context().run, measure, self._generate_sql)
+        (context, search_time), (generated, sql_time) = search.result(), sql.result()
+        self._record_parallel_trace(
+            "Search_And_Generate_SQL",
+            {"Document_Search": search_time, "Generate_SQL": sql_time},
+            time.perf_counter() - start
+        )
+        return self._format_search_and_sql(context, generated)
+
+    async def _asearch_and_generate_sql(self, query: str) -> str:
+        """Run Document_Search and Generate_SQL concurrently on the event loop."""
+        async def measure(coro):
+            start = time.perf_counter()
+            return await coro, time.perf_counter() - start
+
+        start = time.perf_counter()
+        (context, search_time), (generated, sql_time) = await asyncio.gather(
+            measure(self._asearch_documents(query)),
+            measure(self._agenerate_sql(query))
+        )
+        self._record_parallel_trace(
+            "Search_And_Generate_SQL",
+            {"Document_Search": search_time, "Generate_SQL": sql_time},
+            time.perf_counter() - start
+        )
+        return self._format_search_and_sql(context, generated)
+
     def _execute_sql(self, sql: str) -> str:
         """Execute SQL query on the database."""
         try:
-            # 使用数据库工具包执行查询
-            results = self.db_toolkit.execute_query(sql)
-            
-            # 格式化结果
-            if not results:
-                return "No results found."
-            
-            # 获取列名
-            columns = results[0].keys()
-            
-            # 格式化输出
-            formatted_results = []
-            for row in results:
-                formatted_row = []
-                for col in columns:
-                    formatted_row.append(f"{col}: {row[col]}")
-                formatted_results.append(" | ".join(formatted_row))
-            
-            return "\n".join(formatted_results)
+            # 先检查查询（只读、EXPLAIN 估算代价），再在只读事务中执行
+            sql, note = self.db_toolkit.guard_query(sql)
+            rows = self.db_toolkit.execute_query(sql, raw=True, read_only=True)
+            return self._with_note(self._format_sql_results(rows), note)
+        except QueryRejectedError as e:
+            return self._rejected(e)
         except Exception as e:
             logger.error(f"Error executing SQL: {str(e)}")
             return f"Error executing SQL: {str(e)}"
 
-    def run(self, query: str) -> str:
-        """Run the agent on a query."""
+    async def _aexecute_sql(self, sql: str) -> str:
+        """Execute SQL query on the database through the async driver."""
         try:
-            return self.agent_executor.invoke({"input": query})["output"]
+            sql, note = await self.db_toolkit.aguard_query(sql)
+            rows = await self.db_toolkit.aexecute_query(sql, raw=True, read_only=True)
+            return self._with_note(self._format_sql_results(rows), note)
+        except QueryRejectedError as e:
+            return self._rejected(e)
+        except Exception as e:
+            logger.error(f"Error executing SQL: {str(e)}")
+            return f"Error executing SQL: {str(e)}"
+
+    @staticmethod
+    def _with_note(text: str, note: Optional[str]) -> str:
+        return f"{note}\n{text}" if note else text
+
+    @staticmethod
+    def _rejected(error: QueryRejectedError) -> str:
+        """Structured rejection the agent can use to write a cheaper query."""
+        logger.warning(f"SQL rejected by the query guard: {error}")
+        return f"Query rejected: {json.dumps(error.to_dict(), ensure_ascii=False)}"
+
+    def _format_sql_results(self, results: List[Dict[str, Any]]) -> str:
+        """Render rows for the prompt and keep their columnar form for the client."""
+        tables = _sql_tables.get()
+        if tables is not None and results and self.result_formatter.payload_max_rows > 0:
+            tables.append(self.result_formatter.columnar(results))
+        return self.result_formatter.format(results)
+
+    def run(self, query: str, session_id: Optional[str] = None,
+            callbacks: Optional[List[BaseCallbackHandler]] = None,
+            collections: Optional[List[str]] = None) -> str:
+        """Run the agent on a query within the conversation of a session.
+
+        collections restricts Document_Search to these document collections.
+        """
+        return self._run(query, session_id, callbacks, collections)[0]
+
+    def run_with_trace(self, query: str, session_id: Optional[str] = None,
+                       callbacks: Optional[List[BaseCallbackHandler]] = None,
+                       collections: Optional[List[str]] = None) -> Tuple[str, Dict[str, Any]]:
+        """Like run, but also return the trace described in _run."""
+        return self._run(query, session_id, callbacks, collections)
+
+    def _run(self, query: str, session_id: Optional[str],
+             callbacks: Optional[List[BaseCallbackHandler]],
+             collections: Optional[List[str]] = None) -> Tuple[str, Dict[str, Any]]:
+        """Answer a query, returning the output and a trace of how it was answered.
+
+        The trace tells whether the fast path answered, how much wall-clock
+        time parallel tool execution saved and how many conversation history
+        tokens were sent with the prompt, and holds the columnar form of
+        every SQL result for the web client.
+        """
+        with self._query_scope(collections) as (traces, tables):
+            output, fast_path, history_tokens = self._answer(query, session_id, callbacks)
+        return output, self._query_trace(traces, tables, fast_path, history_tokens)
+
+    async def _arun(self, query: str, session_id: Optional[str],
+                    callbacks: Optional[List[BaseCallbackHandler]],
+                    collections: Optional[List[str]] = None) -> Tuple[str, Dict[str, Any]]:
+        """Async variant of _run."""
+        # asyncio tasks copy the context, so traces and tables recorded by tools land in these lists
+        with self._query_scope(collections) as (traces, tables):
+            output, fast_path, history_tokens = await self._aanswer(query, session_id, callbacks)
+        return output, self._query_trace(traces, tables, fast_path, history_tokens)
+
+    @contextmanager
+    def _query_scope(self, collections: Optional[List[str]]
+                     ) -> Iterator[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]:
+        """Set up the per-query state read by the tools, timed and profiled as agent_run."""
+        traces: List[Dict[str, Any]] = []
+        tables: List[Dict[str, Any]] = []
+        tokens = [(_parallel_traces, _parallel_traces.set(traces)),
+                  (_sql_tables, _sql_tables.set(tables)),
+                  (_search_collections, _search_collections.set(collections))]
+        try:
+            with observe("agent_run"), profiled():
+                yield traces, tables
+        finally:
+            for var, token in reversed(tokens):
+                var.reset(token)
+
+    @staticmethod
+    def _query_trace(traces: List[Dict[str, Any]], tables: List[Dict[str, Any]],
+                     fast_path: bool, history_tokens: int) -> Dict[str, Any]:
+        saved_ms = round(sum(t["saved_ms"] for t in traces), 1)
+        if traces:
+            logger.info(f"parallel tools saved {saved_ms} ms on this query")
+        request = current_trace()
+        if request is not None:
+            logger.info(f"trace {request.trace_id} stages: {request.timings_ms()}")
+        return {"fast_path": fast_path, "parallel_saved_ms": saved_ms, "tables": tables,
+                "history_tokens": history_tokens}
+
+    def _remember(self, session_id: Optional[str], memory: TokenBudgetMemory, query: str, output: str):
+        """Save a turn; turns pruned from the history are summarized on the tool pool, off the response path."""
+        if session_id is None:
+            return
+        memory.save_context({"input": query}, {"output": output})
+        if memory.pending:
+            self._tool_pool.submit(memory.summarize_pending)
+
+    def _aremember(self, session_id: Optional[str], memory: TokenBudgetMemory, query: str, output: str):
+        """Save a turn; pruned turns are summarized by a background task with the async LLM client."""
+        if session_id is None:
+            return
+        memory.save_context({"input": query}, {"output": output})
+        if memory.pending:
+            task = asyncio.get_running_loop().create_task(memory.asummarize_pending())
+            # the loop only keeps weak references to tasks
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+
+    def _agent_inputs(self, memory: TokenBudgetMemory, query: str) -> Dict[str, Any]:
+        inputs = {"input": query, **memory.load_memory_variables({})}
+        logger.info(f"conversation history: {memory.last_history_tokens} prompt tokens")
+        return inputs
+
+    def _agent_config(self, callbacks: Optional[List[BaseCallbackHandler]]) -> Dict[str, Any]:
+        return {"callbacks": [self.llm_metrics] + list(callbacks or [])}
+
+    def _answer(self, query: str, session_id: Optional[str],
+                callbacks: Optional[List[BaseCallbackHandler]]) -> Tuple[str, bool, int]:
+        """Answer from the fast path or the agent; returns the output, whether the fast path
+        answered and the history tokens sent with the prompt."""
+        try:
+            memory = self.get_memory(session_id)
+            output = self.router.route(query) if self.router else None
+            if output is not None:
+                self._remember(session_id, memory, query, output)
+                return output, True, 0
+            start = time.perf_counter()
+            output = self.agent_executor.invoke(
+                self._agent_inputs(memory, query), config=self._agent_config(callbacks)
+            )["output"]
+            if self.router:
+                self.router.record_agent_run(time.perf_counter() - start)
+            self._remember(session_id, memory, query, output)
+            return output, False, memory.last_history_tokens
         except Exception as e:
             logger.error(f"Error running agent: {str(e)}")
-            return f"Error: {str(e)}" 
\ No newline at end of file
+            return f"Error: {str(e)}", False, 0
+
+    async def _aanswer(self, query: str, session_id: Optional[str],
+                       callbacks: Optional[List[BaseCallbackHandler]]) -> Tuple[str, bool, int]:
+        """Async variant of _answer."""
+        try:
+            memory = self.get_memory(session_id)
+            output = await self.router.aroute(query) if self.router else None
+            if output is not None:
+                self._aremember(session_id, memory, query, output)
+                return output, True, 0
+            start = time.perf_counter()
+            output = (await self.agent_executor.ainvoke(
+                self._agent_inputs(memory, query), config=self._agent_config(callbacks)
+            ))["output"]
+            if self.router:
+                self.router.record_agent_run(time.perf_counter() - start)
+            self._aremember(session_id, memory, query, output)
+            return output, False, memory.last_history_tokens
+        except Exception as e:
+            logger.error(f"Error running agent: {str(e)}")
+            return f"Error: {str(e)}", False, 0
+
+    async def arun(self, query: str, session_id: Optional[str] = None,
+                   callbacks: Optional[List[BaseCallbackHandler]] = None,
+                   collections: Optional[List[str]] = None) -> str:
+        """Run the agent on a query using async LLM, embedding and database clients."""
+        return (await self._arun(query, session_id, callbacks, collections))[0]
+
+    def stream(self, query: str, session_id: Optional[str] = None,
+               callbacks: Optional[List[BaseCallbackHandler]] = None,
+               collections: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        """Run the agent and yield its progress while it works.
+
+        Yields dicts with a "type" key: "step" when a tool is called,
+        "step_result" when it returns, "token" for each answer token and a
+        last "final" item carrying the output, the time to first token, the
+        number of conversation history tokens sent with the prompt, whether the
+        fast path answered, the time saved by parallel tools and the SQL
+        results as columnar tables.
+        """
+        events: queue.Queue = queue.Queue()
+        handler = TokenStreamHandler(events.put)
+        started_at = time.perf_counter()
+
+        def worker():
+            # the consumer waits for a final event, so one is put however the run ends
+            final = {"type": "final", "output": "Error: the agent run stopped unexpectedly",
+                     "fast_path": False, "parallel_saved_ms": 0.0, "tables": [], "history_tokens": 0}
+            try:
+                output, trace = self._run(query, session_id, [handler] + list(callbacks or []), collections)
+                if trace["fast_path"]:
+                    # the fast path answers without an LLM, so the whole answer is one token
+                    events.put({"type": "token", "token": output})
+                final = {"type": "final", "output": output, **trace}
+            except Exception as e:
+                logger.error(f"Error streaming agent run: {str(e)}")
+                final["output"] = f"Error: {str(e)}"
+            finally:
+                events.put(final)
+
+        # the worker runs in a copy of this context so it belongs to the caller's request trace
+        threading.Thread(target=contextvars.copy_context().run, args=(worker,), daemon=True).start()
+
+        ttft_ms = None
+        while True:
+            event = events.get()
+            if event["type"] == "token" and ttft_ms is None:
+                ttft_ms = round((time.perf_counter() - started_at) * 1000, 1)
+                logger.info(f"time to first token: {ttft_ms} ms")
+            if event["type"] == "final":
+                event["time_to_first_token_ms"] = ttft_ms
+                event["total_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+                yield event
+                return
+            yield event
@@ -0,0 +1,267 @@
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# unit aliases normalised to kilometres per unit
+DISTANCE_UNITS = {
+    "km": 1.0, "kms": 1.0, "kilometer": 1.0, "kilometers": 1.0, "kilometre": 1.0, "kilometres": 1.0,
+    "公里": 1.0, "千米": 1.0,
+    "mi": 1.609344, "mile": 1.609344, "miles": 1.609344, "英里": 1.609344,
+    "m": 0.001, "meter": 0.001, "meters": 0.001, "metre": 0.001, "metres": 0.001, "米": 0.001,
+}
+_UNIT = r"(?P<unit>kilometers?|kilometres?|kms?|miles?|mi|meters?|metres?|m|公里|千米|英里|米)"
+_NUMBER = r"(?P<distance>\d+(?:\.\d+)?)"
+
+# Chinese and common English country names mapped to the adm0name values of places
+COUNTRY_ALIASES = {
+    "中国": "China", "美国": "United States of America", "日本": "Japan", "韩国": "South Korea",
+    "印度": "India", "英国": "United Kingdom", "法国": "France", "德国": "Germany",
+    "俄罗斯": "Russia", "加拿大": "Canada", "澳大利亚": "Australia", "巴西": "Brazil",
+    "意大利": "Italy", "西班牙": "Spain", "墨西哥": "Mexico",
+    "usa": "United States of America", "us": "United States of America",
+    "united states": "United States of America", "america": "United States of America",
+    "uk": "United Kingdom", "britain": "United Kingdom",
+}
+
+# words a question may start with that are not part of a Chinese place name
+_ZH_PREFIXES = ("请问", "请", "帮我", "给我", "查找", "查询", "搜索", "寻找", "找出", "找", "列出", "获取", "查看", "显示", "在")
+
+# questions about uploaded documents always need the full agent
+_DOCUMENT_HINT = re.compile(r"document|文档|文件|资料", re.IGNORECASE)
+
+# aggregates and superlatives that turn a lookup into a question the templates cannot answer
+_EXTRA_CLAUSE = re.compile(
+    r"\b(?:how\s+many|how\s+much|number\s+of|count|average|mean|total|sum|largest|biggest|smallest|"
+    r"most|least|highest|lowest)\b|多少|几个|平均|总共|总数|最多|最少|最大|最小|哪个",
+    re.IGNORECASE)
+
+# everything a question may say around the template itself: polite openers,
+# "which cities are", a trailing "有哪些城市" and punctuation, but no extra clauses
+_EN_LEAD = (
+    r"(?:(?:please|kindly|can\s+you|could\s+you|would\s+you)\s+)?"
+    r"(?:(?:find|show|list|get|give|search(?:\s+for)?|display|tell|what\s+are|which\s+are|which|what|where\s+are)\s+)?"
+    r"(?:(?:me|us)\s+)?(?:(?:the|all)\s+)?"
+    r"(?:(?:cities|places|towns|locations|settlements)\s+(?:(?:that\s+)?(?:are|is|lie|located)\s+)*)?")
+_ZH_LEAD = rf"(?:{'|'.join(_ZH_PREFIXES)})*"
+_ZH_TAIL = r"(?:的|有|都有)?(?:哪些)?(?:城市|地点|地方|城镇)?(?:有哪些|是哪些|都有哪些|有什么|是什么)?"
+_END = r"[\s?.!。？！]*"
+
+
+def _anchored(core: str, lead: str = _EN_LEAD, tail: str = "", flags: int = re.IGNORECASE) -> re.Pattern:
+    """Compile a pattern that has to cover the whole question."""
+    return re.compile(rf"^\s*{lead}{core}{tail}{_END}$", flags)
+
+
+INTENT_PATTERNS: List[Tuple[str, re.Pattern]] = [
+    ("nearby", _anchored(
+        rf"within\s+{_NUMBER}\s*{_UNIT}\s+(?:of|from|around)\s+(?P<place>[^?.!,，？]+?)")),
+    ("nearby", _anchored(
+        rf"(?:距离|距|离)(?P<place>[^\d\s,，?？]+?)(?:附近|周边|周围)?\s*{_NUMBER}\s*{_UNIT}\s*(?:以内|之内|范围内|内)",
+        _ZH_LEAD, _ZH_TAIL, 0)),
+    ("nearby", _anchored(
+        rf"(?P<place>[^\d\s,，?？]+?)(?:附近|周边|周围)\s*{_NUMBER}\s*{_UNIT}(?:以内|之内|范围内|内)?",
+        _ZH_LEAD, _ZH_TAIL, 0)),
+    ("search", _anchored(
+        r"(?:(?:with|whose|having)\s+)?(?:the\s+)?names?\s+(?:containing|contains|that\s+contains?|including|like)\s+"
+        r"['\"“‘]?(?P<term>[^'\"”’?？]+?)['\"”’]?")),
+    ("search", _anchored(
+        r"(?:(?:城市|地点|地方)的?)?(?:名称|名字|地名)中?(?:包含|含有)\s*['\"“‘「]?(?P<term>[^'\"”’」?？的]+)['\"”’」]?",
+        _ZH_LEAD, _ZH_TAIL, 0)),
+    ("top", _anchored(
+        r"top\s+(?P<n>\d+)\s+(?:most\s+populous\s+|largest\s+|biggest\s+)?(?:cities|places|towns)"
+        r"(?:\s+by\s+population)?\s+in\s+(?P<country>[^?.!]+?)")),
+    ("top", _anchored(
+        r"(?:(?P<n>\d+)\s+(?:most\s+populous|largest|biggest)|(?:most\s+populous|largest|biggest)\s+(?P<n2>\d+))"
+        r"\s+(?:cities|places|towns)\s+in\s+(?P<country>[^?.!]+?)")),
+    ("top", _anchored(
+        r"(?P<country>[^\d\s,，?？]+?)(?:人口最多|最大)的(?:前)?(?P<n>\d+)\s*(?:个|座)?(?:城市|地点|地方)",
+        _ZH_LEAD, _ZH_TAIL, 0)),
+    ("top", _anchored(
+        r"(?P<country>[^\d\s,，?？]+?)人口(?:排名)?前\s*(?P<n>\d+)\s*(?:名|位|个)?的?(?:城市|地点|地方)",
+        _ZH_LEAD, _ZH_TAIL, 0)),
+    ("details", _anchored(
+        r"(?:details|detailed\s+information)\s+(?:of|about|on|for)\s+(?P<place>[^?.!]+?)")),
+    ("details", _anchored(
+        r"(?P<place>[^\s,，?？的]+)的(?:详细信息|详情|基本信息)", _ZH_LEAD, _ZH_TAIL, 0)),
+]
+
+
+def _contains_chinese(text: str) -> bool:
+    return re.search(r"[一-鿿]", text) is not None
+
+
+def _clean_name(value: str) -> str:
+    """Strip quotes, articles and leading Chinese verbs around an extracted name."""
+    value = value.strip().strip("'\"“”‘’「」").strip()
+    value = re.sub(r"^(?:the\s+city\s+of|the)\s+", "", value, flags=re.IGNORECASE)
+    value = re.sub(r"\s+by\s+population$", "", value, flags=re.IGNORECASE)
+    changed = True
+    while changed:
+        changed = False
+        for prefix in _ZH_PREFIXES:
+            if value.startswith(prefix) and len(value) > len(prefix):
+                value = value[len(prefix):]
+                changed = True
+    return value.rstrip("的").strip()
+
+
+class IntentRouter:
+    """Fast path in front of the agent for the most common geo questions.
+
+    Questions of the shapes "places within X km of Y", "details of Y",
+    "names containing Y" and "top N by population in Z", in English or
+    Chinese, are answered by running the matching GeoDatabaseToolkit
+    template directly, without any LLM round trip. A pattern has to cover
+    the whole question, so compound questions ("how many cities are within
+    ...") are not mistaken for a plain lookup. Anything else, or a template
+    that returns nothing, falls back to the agent.
+    """
+
+    MAX_LIMIT = 100
+
+    def __init__(self, db_toolkit, formatter: Callable[[List[Dict[str, Any]]], str]):
+        self.db_toolkit = db_toolkit
+        self.formatter = formatter
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "fast_path_seconds": 0.0,
+            "agent_runs": 0,
+            "agent_seconds": 0.0,
+        }
+
+    def match(self, query: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Recognise the intent of a question and extract its parameters."""
+        if _DOCUMENT_HINT.search(query):
+            return None
+        for intent, pattern in INTENT_PATTERNS:
+            m = pattern.match(query)
+            if not m:
+                continue
+            params = self._params(intent, m.groupdict())
+            if params is not None:
+                return intent, params
+        return None
+
+    def _params(self, intent: str, groups: Dict[str, Optional[str]]) -> Optional[Dict[str, Any]]:
+        if any(_EXTRA_CLAUSE.search(groups.get(name) or "") for name in ("place", "country")):
+            return None
+        if intent == "nearby":
+            place = _clean_name(groups["place"])
+            distance_km = float(groups["distance"]) * DISTANCE_UNITS[groups["unit"].lower()]
+            return {"place": place, "distance_km": round(distance_km, 3)} if place else None
+        if intent == "search":
+            term = _clean_name(groups["term"])
+            return {"term": term} if term else None
+        if intent == "details":
+            place = _clean_name(groups["place"])
+            return {"place": place} if place else None
+        if intent == "top":
+            country = _clean_name(groups["country"])
+            country = COUNTRY_ALIASES.get(country, COUNTRY_ALIASES.get(country.lower(), country))
+            n = int(groups.get("n") or groups.get("n2"))
+            return {"country": country, "limit": max(1, min(n, self.MAX_LIMIT))} if country else None
+        return None
+
+    def build_sql(self, intent: str, params: Dict[str, Any]) -> str:
+        """Render the toolkit template for an intent."""
+        if intent == "nearby":
+            return self.db_toolkit.find_nearby_places(params["place"], params["distance_km"])
+        if intent == "search":
+            return self.db_toolkit.search_places_by_name(params["term"])
+        if intent == "details":
+            return self.db_toolkit.get_place_details(params["place"])
+        return self.db_toolkit.top_places_by_population(params["country"], params["limit"])
+
+    def _answer(self, query: str, intent: str, params: Dict[str, Any], rows: List[Dict[str, Any]]) -> str:
+        if _contains_chinese(query):
+            titles = {
+                "nearby": f"距离{params.get('place')} {params.get('distance_km')} 公里内的地点：",
+                "search": f"名称包含“{params.get('term')}”的地点：",
+                "details": f"{params.get('place')}的详细信息：",
+                "top": f"{params.get('country')}人口最多的 {params.get('limit')} 个地点：",
+            }
+        else:
+            titles = {
+                "nearby": f"Places within {params.get('distance_km')} km of {params.get('place')}:",
+                "search": f"Places with names containing '{params.get('term')}':",
+                "details": f"Details of {params.get('place')}:",
+                "top": f"Top {params.get('limit')} places by population in {params.get('country')}:",
+            }
+        return f"{titles[intent]}\n{self.formatter(rows)}"
+
+    def route(self, query: str) -> Optional[str]:
+        """Answer a question on the fast path, or return None to fall back to the agent."""
+        start = time.perf_counter()
+        matched = self.match(query)
+        if matched is None:
+            self._record_miss()
+            return None
+        intent, params = matched
+        try:
+            rows = self.db_toolkit.execute_query(self.build_sql(intent, params))
+        except Exception as e:
+            logger.warning(f"fast path {intent} failed, falling back to agent: {str(e)}")
+            self._record_miss()
+            return None
+        return self._finish(query, intent, params, rows, start)
+
+    async def aroute(self, query: str) -> Optional[str]:
+        """Async variant of route using the async database driver."""
+        start = time.perf_counter()
+        matched = self.match(query)
+        if matched is None:
+            self._record_miss()
+            return None
+        intent, params = matched
+        try:
+            rows = await self.db_toolkit.aexecute_query(self.build_sql(intent, params))
+        except Exception as e:
+            logger.warning(f"fast path {intent} failed, falling back to agent: {str(e)}")
+            self._record_miss()
+            return None
+        return self._finish(query, intent, params, rows, start)
+
+    def _finish(self, query: str, intent: str, params: Dict[str, Any],
+                rows: List[Dict[str, Any]], start: float) -> Optional[str]:
+        if not rows:
+            # e.g. a misspelled place name: the agent can still search more loosely
+            self._record_miss()
+            return None
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._stats["hits"] += 1
+            self._stats["fast_path_seconds"] += elapsed
+        logger.info(f"fast path {intent} {params} answered in {elapsed * 1000:.1f} ms")
+        return self._answer(query, intent, params, rows)
+
+    def _record_miss(self):
+        with self._lock:
+            self._stats["misses"] += 1
+
+    def record_agent_run(self, seconds: float):
+        """Record the latency of a question that went through the full agent."""
+        with self._lock:
+            self._stats["agent_runs"] += 1
+            self._stats["agent_seconds"] += seconds
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit rate and estimated latency saved by the fast path."""
+        with self._lock:
+            s = dict(self._stats)
+        total = s["hits"] + s["misses"]
+        avg_fast_ms = s["fast_path_seconds"] / s["hits"] * 1000 if s["hits"] else 0.0
+        avg_agent_ms = s["agent_seconds"] / s["agent_runs"] * 1000 if s["agent_runs"] else 0.0
+        return {
+            "hits": s["hits"],
+            "misses": s["misses"],
+            "hit_rate": s["hits"] / total if total else 0.0,
+            "avg_fast_path_ms": round(avg_fast_ms, 1),
+            "avg_agent_ms": round(avg_agent_ms, 1),
+            "estimated_latency_saved_ms": round(max(avg_agent_ms - avg_fast_ms, 0.0) * s["hits"], 1),
+        }
@@ -0,0 +1,99 @@
+import argparse
+import math
+import threading
+import time
+from typing import List, Optional
+
+import socketio
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_client(url: str, query: str, queries: int, timeout: float,
+               latencies: List[float], errors: List[str], lock: threading.Lock):
+    """Connect one Socket.IO client and send queries one after another."""
+    client = socketio.Client()
+    answered = threading.Event()
+    outcome = {}
+
+    def on_answer(event):
+        def handler(data):
+            outcome['event'] = event
+            outcome['data'] = data.get('data') if isinstance(data, dict) else data
+            answered.set()
+        return handler
+
+    for event in ('query_response', 'error', 'busy'):
+        client.on(event, on_answer(event))
+
+    try:
+        client.connect(url, wait_timeout=timeout)
+        for _ in range(queries):
+            answered.clear()
+            outcome.clear()
+            start = time.perf_counter()
+            client.emit('query', {'query': query})
+            if not answered.wait(timeout):
+                with lock:
+                    errors.append("timeout")
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                if outcome['event'] == 'query_response':
+                    latencies.append(elapsed)
+                else:
+                    errors.append(f"{outcome['event']}: {outcome['data']}")
+    except Exception as e:
+        with lock:
+            errors.append(f"client failed: {str(e)}")
+    finally:
+        if client.connected:
+            client.disconnect()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Measure query latency under N concurrent Socket.IO clients')
+    parser.add_argument('--url', default='http://localhost:5000', help='Server URL')
+    parser.add_argument('--clients', '-n', type=int, default=8, help='Number of concurrent clients')
+    parser.add_argument('--queries', '-q', type=int, default=3, help='Queries sent by each client')
+    parser.add_argument('--query', default='Which cities are within 100 kilometers of Shanghai?',
+                        help='Question sent by every client')
+    parser.add_argument('--timeout', type=float, default=300.0, help='Seconds to wait for each answer')
+    args = parser.parse_args(argv)
+
+    latencies: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=run_client,
+                         args=(args.url, args.query, args.queries, args.timeout, latencies, errors, lock))
+        for _ in range(args.clients)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+
+    print(f"clients: {args.clients}, queries per client: {args.queries}")
+    print(f"completed: {len(latencies)}, failed: {len(errors)}, wall time: {wall_time:.2f}s")
+    if latencies:
+        print(f"p50: {percentile(latencies, 50):.2f}s  "
+              f"p95: {percentile(latencies, 95):.2f}s  "
+              f"max: {max(latencies):.2f}s")
+        print(f"throughput: {len(latencies) / wall_time:.2f} queries/s")
+    for error in sorted(set(errors)):
+        print(f"error: {error} (x{errors.count(error)})")
+
+
+if __name__ == "__main__":
+    main()
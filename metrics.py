@@ -0,0 +1,211 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from uuid import UUID
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+from prometheus_client import Counter, Gauge, Histogram
+from conversation_memory import count_message_tokens, count_tokens
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_LATENCY = Histogram(
+    "georag_stage_duration_seconds",
+    "Latency of each processing stage",
+    ["stage"],
+    buckets=LATENCY_BUCKETS
+)
+STAGE_ERRORS = Counter(
+    "georag_stage_errors_total",
+    "Stages that raised an exception",
+    ["stage"]
+)
+SQL_GUARD_DECISIONS = Counter(
+    "georag_sql_guard_decisions_total",
+    "Decisions of the guard in front of LLM-generated SQL",
+    ["decision"]
+)
+QUEUE_DEPTH = Gauge(
+    "georag_query_queue_depth",
+    "Admitted queries waiting for a worker"
+)
+QUERIES_RUNNING = Gauge(
+    "georag_queries_running",
+    "Queries currently running on a worker"
+)
+QUEUE_WAIT = Histogram(
+    "georag_query_queue_wait_seconds",
+    "Time admitted queries waited for a worker",
+    buckets=LATENCY_BUCKETS
+)
+ADMISSION_REJECTIONS = Counter(
+    "georag_admission_rejections_total",
+    "Queries turned away by admission control",
+    ["reason"]
+)
+LLM_TOKENS = Counter(
+    "georag_llm_tokens_total",
+    "Tokens sent to and generated by the LLM",
+    ["model", "kind"]
+)
+
+# trace of the request being handled, set by request_trace()
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Trace id and per-stage timings of one request."""
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.started_at = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        # parallel tool branches record stages from several threads
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def timings_ms(self) -> Dict[str, float]:
+        with self._lock:
+            return {stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()}
+
+
+@contextmanager
+def request_trace(trace_id: Optional[str] = None) -> Iterator[Trace]:
+    """Make a new trace current for the duration of a request."""
+    trace = Trace(trace_id)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+def record_stage(stage: str, seconds: float):
+    """Record the duration of a stage in the histogram and the current trace."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+        STAGE_LATENCY.labels(stage=stage).observe(seconds, exemplar={"trace_id": trace.trace_id})
+    else:
+        STAGE_LATENCY.labels(stage=stage).observe(seconds)
+
+
+@contextmanager
+def observe(stage: str) -> Iterator[None]:
+    """Time a block of code as a stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage=stage).inc()
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def timed(stage: str) -> Callable:
+    """Decorator timing every call of a sync or async function as a stage."""
+    def decorator(fn: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with observe(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with observe(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class InstrumentedEmbeddings(Embeddings):
+    """Embeddings wrapper recording every embedding call as the "embedding" stage."""
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with observe("embedding"):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with observe("embedding"):
+            return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        with observe("embedding"):
+            return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        with observe("embedding"):
+            return await self.embeddings.aembed_query(text)
+
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """Record the latency and token counts of every LLM call.
+
+    Streaming responses carry no token usage, so prompt and completion
+    tokens are then counted with tiktoken.
+    """
+
+    def __init__(self):
+        self._runs: Dict[UUID, Dict[str, Any]] = {}
+
+    @staticmethod
+    def _model_name(params: Dict[str, Any]) -> str:
+        return params.get("model_name") or params.get("model") or params.get("_type", "unknown")
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *,
+                            run_id: UUID, **kwargs: Any) -> None:
+        self._runs[run_id] = {
+            "start": time.perf_counter(),
+            "model": self._model_name(kwargs.get("invocation_params") or {}),
+            "prompt_tokens": sum(count_message_tokens(batch) for batch in messages),
+        }
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *,
+                     run_id: UUID, **kwargs: Any) -> None:
+        self._runs[run_id] = {
+            "start": time.perf_counter(),
+            "model": self._model_name(kwargs.get("invocation_params") or {}),
+            "prompt_tokens": sum(count_tokens(p) for p in prompts),
+        }
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        record_stage("llm", time.perf_counter() - run["start"])
+        usage = (getattr(response, "llm_output", None) or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", run["prompt_tokens"])
+        completion_tokens = usage.get("completion_tokens")
+        if completion_tokens is None:
+            completion_tokens = sum(count_tokens(g.text) for gens in response.generations for g in gens)
+        LLM_TOKENS.labels(model=run["model"], kind="prompt").inc(prompt_tokens)
+        LLM_TOKENS.labels(model=run["model"], kind="completion").inc(completion_tokens)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        STAGE_ERRORS.labels(stage="llm").inc()
+        if run is not None:
+            record_stage("llm", time.perf_counter() - run["start"])
@@ -0,0 +1,211 @@
+import contextvars
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+from metrics import current_trace
+import logging
+
+logger = logging.getLogger(__name__)
+
+_PROFILE_ID = re.compile(r"^[0-9]{8}-[0-9]{9}-[0-9a-f]+$")
+
+# capture of the request being profiled, set by Profiler.capture()
+_current_capture: contextvars.ContextVar[Optional["Capture"]] = contextvars.ContextVar("current_capture", default=None)
+
+
+class ProfileStore:
+    """Bounded on-disk ring buffer of captured profiles.
+
+    Every profile is a cProfile dump `<id>.prof` next to `<id>.json` holding
+    what was profiled, its stage timings and its most expensive functions.
+    Once `max_entries` profiles are stored the oldest ones are deleted.
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_entries: Optional[int] = None):
+        self.directory = directory or os.getenv("PROFILE_DIR", "profiles")
+        self.max_entries = max_entries or int(os.getenv("PROFILE_MAX_ENTRIES", "50"))
+        self._lock = threading.Lock()
+
+    def save(self, stats: pstats.Stats, info: Dict[str, Any]) -> str:
+        """Store a profile and return its id."""
+        now = time.time()
+        timestamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}{int(now * 1000) % 1000:03d}"
+        profile_id = f"{timestamp}-{info['trace_id']}"
+        info = {"id": profile_id, **info, "top_functions": self._top_functions(stats)}
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            stats.dump_stats(os.path.join(self.directory, f"{profile_id}.prof"))
+            with open(os.path.join(self.directory, f"{profile_id}.json"), "w", encoding="utf-8") as f:
+                json.dump(info, f, ensure_ascii=False, indent=2)
+            self._prune()
+        return profile_id
+
+    @staticmethod
+    def _top_functions(stats: pstats.Stats, limit: int = 15) -> List[Dict[str, Any]]:
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        return [{
+            "function": f"{os.path.basename(filename)}:{line}({name})",
+            "calls": calls,
+            "tottime_ms": round(tottime * 1000, 2),
+            "cumtime_ms": round(cumtime * 1000, 2),
+        } for (filename, line, name), (_, calls, tottime, cumtime, _) in rows]
+
+    def _ids(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        # ids start with a timestamp, so sorting them sorts by capture time
+        return sorted(name[:-5] for name in os.listdir(self.directory)
+                      if name.endswith(".json") and _PROFILE_ID.match(name[:-5]))
+
+    def _prune(self):
+        ids = self._ids()
+        for profile_id in ids[:max(len(ids) - self.max_entries, 0)]:
+            for ext in (".prof", ".json"):
+                try:
+                    os.remove(os.path.join(self.directory, profile_id + ext))
+                except FileNotFoundError:
+                    pass
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Summaries of the stored profiles, newest first."""
+        profiles = []
+        for profile_id in reversed(self._ids()):
+            try:
+                with open(os.path.join(self.directory, f"{profile_id}.json"), encoding="utf-8") as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                continue
+            info.pop("top_functions", None)
+            profiles.append(info)
+        return profiles
+
+    def path(self, profile_id: str, ext: str = ".prof") -> Optional[str]:
+        """Path of a stored profile file, or None for unknown or malformed ids."""
+        if not _PROFILE_ID.match(profile_id):
+            return None
+        path = os.path.join(self.directory, profile_id + ext)
+        return path if os.path.exists(path) else None
+
+
+class Capture:
+    """cProfile data of one request, collected from every thread working on it."""
+
+    def __init__(self):
+        self.profiles: List[cProfile.Profile] = []
+        self._threads = set()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def profile_thread(self) -> Iterator[None]:
+        thread_id = threading.get_ident()
+        with self._lock:
+            # cProfile profiles one thread; nested sections of the same thread are already covered
+            nested = thread_id in self._threads
+            self._threads.add(thread_id)
+        if nested:
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows only one active profiler per process
+            logger.warning("another profiler is active, thread not profiled")
+            with self._lock:
+                self._threads.discard(thread_id)
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self._lock:
+                self._threads.discard(thread_id)
+                self.profiles.append(profiler)
+
+    def stats(self) -> Optional[pstats.Stats]:
+        with self._lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+@contextmanager
+def profiled() -> Iterator[None]:
+    """Profile the current thread if it works on a request being captured.
+
+    Threads started on behalf of a request (stream workers, tool branches)
+    run their work inside this so their CPU time lands in the request's profile.
+    Without a capture it costs one context variable lookup.
+    """
+    capture = _current_capture.get()
+    if capture is None:
+        yield
+        return
+    with capture.profile_thread():
+        yield
+
+
+class Profiler:
+    """Decide which requests to profile and store what was captured.
+
+    A request is profiled when the caller asks for it or, at
+    `PROFILE_SAMPLE_RATE` (0 by default, i.e. never), at random.
+    """
+
+    def __init__(self, store: Optional[ProfileStore] = None, sample_rate: Optional[float] = None):
+        self.store = store or ProfileStore()
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+
+    def should_profile(self, requested: bool = False) -> bool:
+        return requested or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    @contextmanager
+    def capture(self, kind: str, label: str, requested: bool = False) -> Iterator[Dict[str, Optional[str]]]:
+        """Profile the enclosed request if it is selected.
+
+        Yields a dict whose "profile_id" is set once the profile is stored.
+        Call inside metrics.request_trace() so the stage timings are saved too.
+        """
+        result: Dict[str, Optional[str]] = {"profile_id": None}
+        if not self.should_profile(requested):
+            yield result
+            return
+
+        capture = Capture()
+        token = _current_capture.set(capture)
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            with capture.profile_thread():
+                yield result
+        finally:
+            _current_capture.reset(token)
+            duration_ms = round((time.perf_counter() - start) * 1000, 1)
+            stats = capture.stats()
+            if stats is not None:
+                trace = current_trace()
+                try:
+                    result["profile_id"] = self.store.save(stats, {
+                        "kind": kind,
+                        "label": label[:200],
+                        "trace_id": trace.trace_id if trace else f"{random.getrandbits(64):016x}",
+                        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(started_at)),
+                        "duration_ms": duration_ms,
+                        "threads": len(capture.profiles),
+                        "stages_ms": trace.timings_ms() if trace else {},
+                    })
+                    logger.info(f"profile {result['profile_id']} captured for {kind} ({duration_ms} ms)")
+                except OSError as e:
+                    logger.error(f"failed to store profile: {str(e)}")
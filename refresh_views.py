@@ -0,0 +1,30 @@
+from dotenv import load_dotenv
+from geo_db_toolkit import AGGREGATE_VIEWS, GeoDatabaseToolkit
+import argparse
+
+def main():
+    # Load environment variables
+    load_dotenv()
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Create and refresh the aggregate views over places')
+    parser.add_argument('--create', action='store_true', help='Create missing views before refreshing')
+    parser.add_argument('--blocking', action='store_true',
+                        help='Refresh without CONCURRENTLY (faster, but readers wait until it finishes)')
+    args = parser.parse_args()
+
+    toolkit = GeoDatabaseToolkit()
+
+    created = []
+    if args.create:
+        created = toolkit.create_aggregate_views()
+        print(f"Created: {', '.join(created) or 'nothing, all views exist'}")
+
+    # Refresh the views, e.g. from cron after places is updated; new views are already up to date
+    names = [name for name in AGGREGATE_VIEWS if name not in created]
+    for name, seconds in toolkit.refresh_aggregate_views(concurrently=not args.blocking, names=names).items():
+        print(f"Refreshed {name} in {seconds:.2f} s")
+    print("Done!")
+
+if __name__ == "__main__":
+    main()
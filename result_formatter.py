@@ -0,0 +1,151 @@
+import datetime
+import decimal
+import os
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence
+from conversation_memory import count_tokens
+import logging
+
+logger = logging.getLogger(__name__)
+
+# rounding rules chosen by column name
+COORDINATE_COLUMNS = re.compile(r"^(?:lat|latitude|lon|lng|long|longitude)$|_(?:lat|lon|lng)$", re.IGNORECASE)
+POPULATION_COLUMNS = re.compile(r"^pop|population", re.IGNORECASE)
+DISTANCE_COLUMNS = re.compile(r"dist|_km$|_m$", re.IGNORECASE)
+
+_FLOAT = re.compile(r"^-?\d+\.\d+(?:[eE][-+]?\d+)?$")
+_INT = re.compile(r"^-?\d+$")
+
+
+class ResultFormatter:
+    """Render SQL results for the LLM prompt and the web client.
+
+    The compact mode writes the column names once, rounds coordinates to 4
+    decimals, populations to integers and distances to 2 decimals, and stops
+    after `max_rows` rows or `token_budget` tokens. The rows left out are
+    described by a one-line aggregate summary instead. The verbose mode
+    keeps the old `col: value | col: value` rendering of every row.
+    """
+
+    def __init__(self, mode: Optional[str] = None, max_rows: Optional[int] = None,
+                 token_budget: Optional[int] = None, max_cell_chars: int = 80,
+                 payload_max_rows: Optional[int] = None, model_name: str = "gpt-4"):
+        self.mode = mode or os.getenv("SQL_RESULT_FORMAT", "compact")
+        self.max_rows = max_rows or int(os.getenv("SQL_RESULT_MAX_ROWS", "50"))
+        self.token_budget = token_budget or int(os.getenv("SQL_RESULT_TOKEN_BUDGET", "1000"))
+        self.max_cell_chars = max_cell_chars
+        self.payload_max_rows = (payload_max_rows if payload_max_rows is not None
+                                 else int(os.getenv("SQL_RESULT_PAYLOAD_MAX_ROWS", "500")))
+        self.model_name = model_name
+
+    @staticmethod
+    def number(column: str, value: Any) -> Optional[Any]:
+        """The rounded number a value stands for, or None if it is not numeric."""
+        if isinstance(value, bool) or value is None:
+            return None
+        if isinstance(value, str):
+            text = value.strip()
+            if _FLOAT.match(text):
+                value = float(text)
+            elif _INT.match(text) and (POPULATION_COLUMNS.search(column) or DISTANCE_COLUMNS.search(column)
+                                       or COORDINATE_COLUMNS.search(column)):
+                # other integer-looking strings may be codes, keep them as text
+                value = int(text)
+            else:
+                return None
+        if isinstance(value, decimal.Decimal):
+            value = float(value)
+        if not isinstance(value, (int, float)):
+            return None
+        if COORDINATE_COLUMNS.search(column):
+            return round(float(value), 4)
+        if POPULATION_COLUMNS.search(column):
+            return int(round(value))
+        if DISTANCE_COLUMNS.search(column):
+            return round(float(value), 2)
+        return value if isinstance(value, int) else round(value, 3)
+
+    def normalize(self, column: str, value: Any) -> Any:
+        """A JSON-serialisable, rounded version of a value."""
+        number = self.number(column, value)
+        if number is not None:
+            return number
+        if value is None or isinstance(value, (bool, str)):
+            return value
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        if isinstance(value, (bytes, memoryview)):
+            return bytes(value).hex()
+        return str(value)
+
+    def cell(self, column: str, value: Any) -> str:
+        value = self.normalize(column, value)
+        if value is None:
+            return ""
+        text = re.sub(r"\s+", " ", str(value)).replace("|", "/")
+        if len(text) > self.max_cell_chars:
+            text = text[:self.max_cell_chars - 1] + "…"
+        return text
+
+    def format(self, rows: List[Dict[str, Any]]) -> str:
+        """Render rows as prompt text."""
+        if not rows:
+            return "No results found."
+        if self.mode == "verbose":
+            return "\n".join(" | ".join(f"{col}: {row[col]}" for col in row) for row in rows)
+
+        columns = list(rows[0].keys())
+        header = " | ".join(columns)
+        lines = [header]
+        tokens = count_tokens(header, self.model_name)
+        for row in rows[:self.max_rows]:
+            line = " | ".join(self.cell(col, row.get(col)) for col in columns)
+            line_tokens = count_tokens(line, self.model_name) + 1
+            if tokens + line_tokens > self.token_budget:
+                break
+            lines.append(line)
+            tokens += line_tokens
+
+        shown = len(lines) - 1
+        if shown < len(rows):
+            lines.append(
+                f"... {len(rows) - shown} more rows not shown ({len(rows)} total). "
+                f"Not shown: {self.summarize(columns, rows[shown:])}"
+            )
+        return "\n".join(lines)
+
+    def summarize(self, columns: Sequence[str], rows: List[Dict[str, Any]]) -> str:
+        """One-line aggregate of rows: ranges of numeric columns, top values of the others."""
+        parts = []
+        for col in columns:
+            values = [row.get(col) for row in rows if row.get(col) is not None]
+            if not values:
+                continue
+            numbers = [self.number(col, v) for v in values]
+            if all(n is not None for n in numbers):
+                part = f"{col} {min(numbers)}..{max(numbers)}"
+                if POPULATION_COLUMNS.search(col):
+                    part += f" (sum {sum(numbers)})"
+                parts.append(part)
+                continue
+            counts = Counter(self.cell(col, v) for v in values)
+            if len(counts) > len(values) / 2:
+                # mostly unique text such as names: a list of values would not be shorter than the rows
+                parts.append(f"{col} {len(counts)} distinct")
+                continue
+            top = ", ".join(f"{value} {count}" for value, count in counts.most_common(3))
+            more = f", +{len(counts) - 3} more" if len(counts) > 3 else ""
+            parts.append(f"{col} {top}{more}")
+        return "; ".join(parts)
+
+    def columnar(self, rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Rows as a JSON columnar payload for the web client."""
+        columns = list(rows[0].keys()) if rows else []
+        kept = rows[:self.payload_max_rows]
+        return {
+            "columns": columns,
+            "row_count": len(rows),
+            "truncated": len(kept) < len(rows),
+            "data": {col: [self.normalize(col, row.get(col)) for row in kept] for col in columns},
+        }
@@ -0,0 +1,220 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, Any, Optional, Tuple
+from metrics import ADMISSION_REJECTIONS, QUERIES_RUNNING, QUEUE_DEPTH, QUEUE_WAIT
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a query is not admitted; retry_after is a hint in seconds."""
+
+    reason = "rejected"
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_seconds(self) -> int:
+        """retry_after rounded up to whole seconds, as used by the Retry-After header."""
+        return max(1, math.ceil(self.retry_after))
+
+
+class SessionLimitExceeded(AdmissionRejected):
+    """Raised when a session already has the maximum number of queries in flight."""
+
+    reason = "session_limit"
+
+
+class QueueFull(AdmissionRejected):
+    """Raised when every worker is busy and the wait queue is full."""
+
+    reason = "queue_full"
+
+
+class RateLimited(AdmissionRejected):
+    """Raised when a client sends queries faster than its rate limit."""
+
+    reason = "rate_limited"
+
+
+class AdmissionRejections:
+    """Counts rejected queries by reason, on /metrics and for the stats endpoint."""
+
+    def __init__(self):
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, error: AdmissionRejected) -> AdmissionRejected:
+        """Count a rejection and return it, so callers can `raise rejections.record(...)`."""
+        with self._lock:
+            self._counts[error.reason] = self._counts.get(error.reason, 0) + 1
+        ADMISSION_REJECTIONS.labels(reason=error.reason).inc()
+        logger.warning(f"query rejected ({error.reason}): {str(error)}")
+        return error
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+
+class RateLimiter:
+    """Per-client token buckets.
+
+    Every client may send `burst` queries at once and then one query per
+    60 / `rate_per_minute` seconds. A rate of 0 disables the limit.
+    Pass the worker pool's `rejections` so its stats include rate limiting.
+    """
+
+    def __init__(self, rate_per_minute: Optional[float] = None, burst: Optional[int] = None,
+                 max_clients: int = 10000, rejections: Optional[AdmissionRejections] = None):
+        self.rate_per_minute = (rate_per_minute if rate_per_minute is not None
+                                else float(os.getenv("QUERY_RATE_PER_MINUTE", "20")))
+        self.burst = burst or int(os.getenv("QUERY_RATE_BURST", "5"))
+        self.max_clients = max_clients
+        self.rejections = rejections or AdmissionRejections()
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def check(self, client_id: str):
+        """Take a token from the client's bucket or raise RateLimited."""
+        if self.rate_per_minute <= 0:
+            return
+        rate = self.rate_per_minute / 60
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(client_id, (float(self.burst), now))
+            tokens = min(float(self.burst), tokens + (now - updated) * rate)
+            if tokens < 1:
+                self._buckets[client_id] = (tokens, now)
+                raise self.rejections.record(RateLimited(
+                    f"rate limit of {self.rate_per_minute:g} queries per minute exceeded, please slow down",
+                    retry_after=(1 - tokens) / rate
+                ))
+            self._buckets[client_id] = (tokens - 1, now)
+            if len(self._buckets) > self.max_clients:
+                self._forget_idle(now, rate)
+
+    def _forget_idle(self, now: float, rate: float):
+        # a client whose bucket has refilled completely is indistinguishable from a new one
+        full_after = self.burst / rate
+        for client_id, (_, updated) in list(self._buckets.items()):
+            if now - updated >= full_after:
+                del self._buckets[client_id]
+
+
+class QueryWorkerPool:
+    """Bounded worker pool that runs agent queries in parallel.
+
+    The pool size caps how many agent invocations run at once, and the
+    per-session limit stops a single client from occupying every worker.
+    At most `max_queue` queries wait for a worker; beyond that new queries
+    are rejected at once with a retry hint instead of timing out later.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, max_per_session: Optional[int] = None,
+                 max_queue: Optional[int] = None, rejections: Optional[AdmissionRejections] = None):
+        self.max_workers = max_workers or int(os.getenv("QUERY_MAX_WORKERS", "4"))
+        self.max_per_session = max_per_session or int(os.getenv("QUERY_MAX_PER_SESSION", "1"))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv("QUERY_MAX_QUEUE", "16"))
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="geo-query"
+        )
+        self._in_flight: Dict[str, int] = {}
+        self._pending = 0
+        self._running = 0
+        # moving average of how long a query holds a worker, used for retry hints
+        self._avg_service_seconds = 2.0
+        self.rejections = rejections or AdmissionRejections()
+        self._lock = threading.Lock()
+        logger.info(
+            f"query worker pool started: {self.max_workers} workers, {self.max_queue} queued, "
+            f"{self.max_per_session} queries per session"
+        )
+
+    def in_flight(self, session_id: str) -> int:
+        """Number of queries of a session that are queued or running."""
+        with self._lock:
+            return self._in_flight.get(session_id, 0)
+
+    def _retry_after(self, waiting: int) -> float:
+        return min(max(self._avg_service_seconds * (waiting + 1) / self.max_workers, 1.0), 60.0)
+
+    def submit(self, session_id: str, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Schedule fn on the pool on behalf of a session."""
+        with self._lock:
+            count = self._in_flight.get(session_id, 0)
+            if count >= self.max_per_session:
+                raise self.rejections.record(SessionLimitExceeded(
+                    f"session already has {count} queries in progress, please wait for them to finish",
+                    retry_after=self._retry_after(0)
+                ))
+            waiting = self._pending - self.max_workers
+            if waiting >= self.max_queue:
+                raise self.rejections.record(QueueFull(
+                    "the server is busy, please try again shortly",
+                    retry_after=self._retry_after(waiting)
+                ))
+            self._in_flight[session_id] = count + 1
+            self._pending += 1
+            self._update_gauges()
+
+        submitted_at = time.perf_counter()
+
+        def run():
+            started_at = time.perf_counter()
+            QUEUE_WAIT.observe(started_at - submitted_at)
+            with self._lock:
+                self._running += 1
+                self._update_gauges()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._avg_service_seconds += 0.2 * (time.perf_counter() - started_at - self._avg_service_seconds)
+
+        try:
+            future = self.executor.submit(run)
+        except Exception:
+            self._release(session_id)
+            raise
+        future.add_done_callback(lambda _: self._release(session_id))
+        return future
+
+    def _release(self, session_id: str):
+        with self._lock:
+            self._pending -= 1
+            self._update_gauges()
+            count = self._in_flight.get(session_id, 0) - 1
+            if count > 0:
+                self._in_flight[session_id] = count
+            else:
+                self._in_flight.pop(session_id, None)
+
+    def _update_gauges(self):
+        QUERIES_RUNNING.set(self._running)
+        QUEUE_DEPTH.set(max(self._pending - self._running, 0))
+
+    def stats(self) -> Dict[str, Any]:
+        """Current load, capacity and rejections, for tuning the limits."""
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "max_per_session": self.max_per_session,
+                "running": self._running,
+                "queued": max(self._pending - self._running, 0),
+                "avg_service_ms": round(self._avg_service_seconds * 1000, 1),
+                "rejections": self.rejections.counts(),
+            }
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting work and release the worker threads."""
+        self.executor.shutdown(wait=wait)
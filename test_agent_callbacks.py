@@ -0,0 +1,74 @@
+from uuid import uuid4
+
+from agent_callbacks import AgentEventHandler, EventBatcher
+from geo_rag_agent import GeoRAGAgent
+
+
+def make_batcher(**kwargs):
+    batches = []
+    # a long interval keeps the timer from flushing while a test runs
+    return EventBatcher(batches.append, interval=60, **kwargs), batches
+
+
+def test_tool_start_is_coalesced_with_its_tool_end():
+    batcher, batches = make_batcher()
+
+    batcher.add({"type": "tool_start", "run_id": "r1", "tool": "Execute_SQL", "input": "SELECT 1"})
+    batcher.add({"type": "tool_end", "run_id": "r1", "tool": "Execute_SQL", "output": "1"})
+    batcher.add({"type": "tool_end", "run_id": "r2", "tool": "Generate_SQL", "output": "SELECT 2"})
+    batcher.flush()
+
+    assert batches == [[
+        {"type": "tool", "run_id": "r1", "tool": "Execute_SQL", "input": "SELECT 1", "output": "1"},
+        {"type": "tool_end", "run_id": "r2", "tool": "Generate_SQL", "output": "SELECT 2"},
+    ]]
+
+
+def test_batch_is_sent_when_max_batch_is_reached():
+    batcher, batches = make_batcher(max_batch=2)
+
+    batcher.add({"type": "llm_start", "run_id": "r1"})
+    assert batches == []
+    batcher.add({"type": "llm_end", "run_id": "r1"})
+
+    assert [[e["type"] for e in batch] for batch in batches] == [["llm_start", "llm_end"]]
+    batcher.close()
+
+
+def test_events_after_close_are_dropped():
+    batcher, batches = make_batcher()
+
+    batcher.add({"type": "llm_start", "run_id": "r1"})
+    batcher.close()
+    batcher.add({"type": "llm_end", "run_id": "r1"})
+    batcher.flush()
+
+    assert [[e["type"] for e in batch] for batch in batches] == [["llm_start"]]
+
+
+def test_sql_text_is_extracted_from_sql_tools():
+    events = []
+    handler = AgentEventHandler(events.append)
+
+    def call(tool, input_str, output):
+        run_id = uuid4()
+        handler.on_tool_start({"name": tool}, input_str, run_id=run_id)
+        handler.on_tool_end(output, run_id=run_id)
+
+    call("Execute_SQL", "SELECT name FROM places", "[]")
+    call("Generate_SQL", "largest city", "SELECT name FROM places ORDER BY pop_max DESC LIMIT 1")
+    call("Search_And_Generate_SQL", "largest city",
+         GeoRAGAgent._format_search_and_sql("Shanghai is large.", "SELECT name FROM places LIMIT 1"))
+    call("Document_Search", "Shanghai", "Shanghai is large.")
+
+    assert [(e["type"], e["tool"], e.get("sql")) for e in events] == [
+        ("tool_start", "Execute_SQL", "SELECT name FROM places"),
+        ("tool_end", "Execute_SQL", None),
+        ("tool_start", "Generate_SQL", None),
+        ("tool_end", "Generate_SQL", "SELECT name FROM places ORDER BY pop_max DESC LIMIT 1"),
+        ("tool_start", "Search_And_Generate_SQL", None),
+        ("tool_end", "Search_And_Generate_SQL", "SELECT name FROM places LIMIT 1"),
+        ("tool_start", "Document_Search", None),
+        ("tool_end", "Document_Search", None),
+    ]
+    assert all("duration_ms" in e for e in events if e["type"] == "tool_end")
@@ -0,0 +1,44 @@
+from sqlalchemy import text
+
+from benchmark import AGGREGATE_QUERIES, create_places_standin
+from fake_models import FakeStreamingChatModel
+from geo_db_toolkit import AGGREGATE_VIEWS, GeoDatabaseToolkit
+
+
+def make_toolkit(rows=300):
+    return GeoDatabaseToolkit(engine=create_places_standin(rows), llm=FakeStreamingChatModel(responses=["-"]))
+
+
+def test_views_match_the_raw_aggregates():
+    toolkit = make_toolkit()
+
+    assert toolkit.create_aggregate_views() == list(AGGREGATE_VIEWS)
+    assert toolkit.create_aggregate_views() == []
+
+    for raw_sql, view_sql in AGGREGATE_QUERIES.values():
+        assert sorted(map(tuple, (r.values() for r in toolkit.execute_query(raw_sql)))) == \
+            sorted(map(tuple, (r.values() for r in toolkit.execute_query(view_sql))))
+
+
+def test_refresh_picks_up_new_places():
+    toolkit = make_toolkit()
+    toolkit.create_aggregate_views()
+    with toolkit.engine.begin() as connection:
+        connection.execute(text("INSERT INTO places (gid, name, adm0name, adm1name, featurecla, pop_max) "
+                                "VALUES (100000, 'Atlantis', 'Atlantis', 'Deep', 'Port', 1)"))
+
+    toolkit.refresh_aggregate_views()
+
+    assert toolkit.execute_query(
+        "SELECT place_count, largest_place FROM places_by_country WHERE adm0name = 'Atlantis'", raw=True
+    ) == [{"place_count": 1, "largest_place": "Atlantis"}]
+
+
+def test_views_are_described_only_once_they_exist():
+    toolkit = make_toolkit(10)
+    assert toolkit.describe_aggregate_views() == ""
+
+    toolkit.create_aggregate_views()
+
+    description = toolkit.describe_aggregate_views()
+    assert all(f"public.{name}" in description for name in AGGREGATE_VIEWS)
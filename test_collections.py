@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+from langchain_core.documents import Document
+
+from document_processor import DocumentProcessor
+from fake_models import FakeEmbeddings
+
+
+def make_processor(tmp_path):
+    return DocumentProcessor(embeddings=FakeEmbeddings(), index_path=str(tmp_path / "faiss_index"))
+
+
+def add(processor, collection, *texts):
+    processor.process_documents([Document(page_content=text, metadata={"source": collection}) for text in texts],
+                                collection)
+
+
+def test_collections_are_saved_and_loaded_as_separate_shards(tmp_path):
+    processor = make_processor(tmp_path)
+    add(processor, "default", "The Bund is a waterfront in Shanghai.")
+    add(processor, "team-a", "West Lake is a freshwater lake in Hangzhou.")
+
+    assert (tmp_path / "faiss_index" / "index.faiss").exists()
+    assert (tmp_path / "faiss_index_collections" / "team-a" / "index.faiss").exists()
+
+    reloaded = make_processor(tmp_path)
+    assert reloaded.load_vectorstores() == ["default", "team-a"]
+    assert reloaded.list_collections() == {"default": 1, "team-a": 1}
+
+
+def test_searches_target_collections_or_fan_out(tmp_path):
+    processor = make_processor(tmp_path)
+    add(processor, "shanghai", "The Bund is a waterfront in Shanghai.", "Yu Garden is a classical garden.")
+    add(processor, "hangzhou", "West Lake is a freshwater lake in Hangzhou.", "Lingyin Temple is near West Lake.")
+
+    merged = processor.search_documents("West Lake in Hangzhou", k=2)
+    assert [r["metadata"]["source"] for r in merged] == ["hangzhou", "hangzhou"]
+
+    only = processor.mmr_search_documents("West Lake in Hangzhou", k=2, fetch_k=4, collections=["shanghai"])
+    assert {r["metadata"]["source"] for r in only} == {"shanghai"}
+
+    assert asyncio.run(processor.asearch_documents("West Lake", k=4)) == processor.search_documents("West Lake", k=4)
+
+
+def test_unknown_and_invalid_collections_are_rejected(tmp_path):
+    processor = make_processor(tmp_path)
+    add(processor, "default", "The Bund is a waterfront in Shanghai.")
+
+    with pytest.raises(ValueError, match="unknown collection"):
+        processor.search_documents("Bund", collections=["missing"])
+    with pytest.raises(ValueError, match="invalid collection name"):
+        add(processor, "../escape", "text")
+
+
+def test_updates_swap_in_a_copy_of_the_shard(tmp_path):
+    processor = make_processor(tmp_path)
+    add(processor, "default", "The Bund is a waterfront in Shanghai.")
+    searched = processor.vectorstores["default"]
+
+    add(processor, "default", "West Lake is a freshwater lake in Hangzhou.")
+
+    assert searched.index.ntotal == len(searched.index_to_docstore_id) == 1
+    assert processor.list_collections() == {"default": 2}
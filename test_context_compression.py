@@ -0,0 +1,58 @@
+from context_compression import ContextCompressor
+
+TEXT = " ".join(f"Shanghai district {i} has a river port and a museum." for i in range(40))
+
+
+def chunk(start, end, source="docs/shanghai.txt", with_index=True):
+    metadata = {"source": source}
+    if with_index:
+        metadata["start_index"] = start
+    return {"content": TEXT[start:end], "metadata": metadata}
+
+
+def test_near_duplicates_are_dropped():
+    compressor = ContextCompressor()
+    results = [chunk(0, 300), chunk(0, 300, source="docs/copy.txt"), chunk(10, 200, source="docs/other.txt")]
+
+    assert compressor.deduplicate(results) == [results[0]]
+
+
+def test_adjacent_chunks_of_a_source_are_merged_by_position():
+    compressor = ContextCompressor()
+    results = [chunk(0, 500), chunk(900, 1400), chunk(450, 950)]
+
+    merged = compressor.merge_adjacent(results)
+
+    assert merged == [{"content": TEXT[0:1400], "metadata": results[0]["metadata"]}]
+
+
+def test_adjacent_chunks_without_start_index_are_merged_by_overlap():
+    compressor = ContextCompressor()
+    results = [chunk(500, 1000, with_index=False), chunk(950, 1450, with_index=False)]
+
+    merged = compressor.merge_adjacent(results)
+
+    assert [m["content"] for m in merged] == [TEXT[500:1450]]
+
+
+def test_chunks_sharing_only_a_few_characters_are_not_merged():
+    compressor = ContextCompressor()
+    # consecutive chunks share only "museum." and "." at their edges, far less than a splitter overlap
+    first = {"content": "Shanghai has a museum.", "metadata": {"source": "docs/a.txt"}}
+    second = {"content": "museum. Hangzhou has a lake.", "metadata": {"source": "docs/a.txt"}}
+    third = {"content": ". Suzhou has gardens.", "metadata": {"source": "docs/a.txt"}}
+
+    merged = compressor.merge_adjacent([first, second, third])
+
+    assert [m["content"] for m in merged] == [first["content"], second["content"], third["content"]]
+
+
+def test_compress_respects_token_budget():
+    compressor = ContextCompressor(token_budget=120)
+    results = [chunk(i, i + 500, source=f"docs/{i}.txt") for i in range(0, 2000, 500)]
+
+    text, stats = compressor.compress(results)
+
+    assert stats["tokens_after"] <= 120 < stats["tokens_before"]
+    assert stats["tokens_saved"] == stats["tokens_before"] - stats["tokens_after"]
+    assert text.startswith(f"Content: {TEXT[0:40]}")
@@ -0,0 +1,85 @@
+import asyncio
+
+import conversation_memory
+from conversation_memory import TokenBudgetMemory
+from fake_models import FakeStreamingChatModel
+
+
+def history_tokens(memory):
+    memory.load_memory_variables({})
+    return memory.last_history_tokens
+
+
+def test_history_tokens_stay_within_budget():
+    memory = TokenBudgetMemory(max_token_limit=200, max_message_tokens=100)
+
+    for turn in range(50):
+        memory.save_context({"input": f"question {turn} about Shanghai and nearby cities"},
+                            {"output": f"answer {turn}: " + "Suzhou, Hangzhou, Ningbo. " * 5})
+        assert history_tokens(memory) <= 200
+
+    # the latest turn is always kept verbatim
+    assert "answer 49" in memory.chat_memory.messages[-1].content
+
+
+def test_large_outputs_are_replaced_by_references():
+    memory = TokenBudgetMemory(max_token_limit=2000, max_message_tokens=50)
+    table = "\n".join(f"name: City {i} | pop_max: {i * 1000}" for i in range(200))
+
+    memory.save_context({"input": "list cities"}, {"output": table})
+
+    stored = memory.chat_memory.messages[-1].content
+    ref_id = stored.rsplit("ref:", 1)[1].rstrip("]")
+    assert len(stored) < len(table) / 10
+    assert memory.get_reference(ref_id) == table
+
+
+def test_pruned_turns_are_summarized_when_llm_given():
+    llm = FakeStreamingChatModel(responses=["User asked about cities near Shanghai."])
+    memory = TokenBudgetMemory(max_token_limit=60, max_message_tokens=50, llm=llm)
+
+    for turn in range(5):
+        memory.save_context({"input": f"question {turn} " * 5}, {"output": f"answer {turn} " * 5})
+    assert memory.summary == ""
+
+    memory.summarize_pending()
+
+    assert memory.summary == "User asked about cities near Shanghai."
+    assert memory.pending == []
+    messages = memory.load_memory_variables({})["chat_history"]
+    assert "User asked about cities near Shanghai." in messages[0].content
+
+
+def test_long_summaries_are_capped_to_their_share_of_the_budget():
+    llm = FakeStreamingChatModel(responses=["Shanghai, Suzhou and Hangzhou were discussed. " * 100])
+    memory = TokenBudgetMemory(max_token_limit=200, max_message_tokens=40, llm=llm)
+
+    for turn in range(20):
+        asyncio.run(memory.asave_context({"input": f"question {turn} about Shanghai and nearby cities"},
+                                         {"output": f"answer {turn}: " + "Suzhou, Hangzhou, Ningbo. " * 5}))
+        assert history_tokens(memory) <= 200
+
+    assert memory.summary.startswith("Shanghai, Suzhou and Hangzhou")
+
+
+def test_references_are_dropped_with_their_messages():
+    memory = TokenBudgetMemory(max_token_limit=300, max_message_tokens=50)
+
+    for turn in range(20):
+        table = "\n".join(f"name: City {turn}-{i} | pop_max: {i * 1000}" for i in range(50))
+        memory.save_context({"input": f"list cities {turn}"}, {"output": table})
+
+    assert len(memory.references) == len(memory.chat_memory.messages) // 2
+
+
+def test_token_counts_are_approximated_when_tiktoken_cannot_load(monkeypatch):
+    def offline(*args, **kwargs):
+        raise ConnectionError("no network")
+
+    monkeypatch.setattr(conversation_memory.tiktoken, "encoding_for_model", offline)
+    conversation_memory._encoding.cache_clear()
+    try:
+        assert conversation_memory.count_tokens("x" * 40, "offline-model") == 10
+        assert conversation_memory.truncate_tokens("abcdefgh", 1, "offline-model") == "abcd"
+    finally:
+        conversation_memory._encoding.cache_clear()
@@ -0,0 +1,61 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from intent_router import IntentRouter
+
+
+@pytest.fixture
+def router():
+    return IntentRouter(MagicMock(), lambda rows: "\n".join(r["name"] for r in rows))
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("Which cities are within 100 kilometers of Shanghai?", ("nearby", {"place": "Shanghai", "distance_km": 100.0})),
+    ("Find places within 50 miles of New York.", ("nearby", {"place": "New York", "distance_km": 80.467})),
+    ("距离北京100公里内有哪些城市？", ("nearby", {"place": "北京", "distance_km": 100.0})),
+    ("上海附近50公里的城市", ("nearby", {"place": "上海", "distance_km": 50.0})),
+    ("Find locations with names containing 'Beijing'", ("search", {"term": "Beijing"})),
+    ("搜索名称包含'北京'的地点", ("search", {"term": "北京"})),
+    ("What are the top 10 most populous cities in the USA?",
+     ("top", {"country": "United States of America", "limit": 10})),
+    ("中国人口最多的5个城市", ("top", {"country": "China", "limit": 5})),
+    ("Get details of Shanghai", ("details", {"place": "Shanghai"})),
+    ("获取上海的详细信息", ("details", {"place": "上海"})),
+])
+def test_match_common_intents(router, query, expected):
+    assert router.match(query) == expected
+
+
+@pytest.mark.parametrize("query", [
+    "What are the famous attractions in Shanghai?",
+    "请介绍一下上海的历史",
+    "Which cities mentioned in the documents are within 100 km of Beijing?",
+    "How many cities are within 100 km of Shanghai?",
+    "What's the average population of places within 50 miles of London?",
+    "距离北京100公里内人口最多的城市是哪个？",
+    "Which cities are within 100 km of Shanghai, and how many people live there?",
+    "Get details of the largest city within 100 km of Shanghai",
+    "中国人口最多的5个城市的平均人口是多少？",
+])
+def test_other_questions_go_to_the_agent(router, query):
+    assert router.match(query) is None
+
+
+def test_route_runs_template_and_tracks_hits(router):
+    router.db_toolkit.execute_query.return_value = [{"name": "Suzhou"}, {"name": "Kunshan"}]
+
+    answer = router.route("Which cities are within 100 km of Shanghai?")
+
+    router.db_toolkit.find_nearby_places.assert_called_once_with("Shanghai", 100.0)
+    assert answer.endswith("Suzhou\nKunshan")
+    assert router.stats()["hits"] == 1
+
+
+def test_route_falls_back_when_template_finds_nothing(router):
+    router.db_toolkit.execute_query.return_value = []
+
+    assert router.route("Get details of Atlantis") is None
+    router.record_agent_run(2.0)
+    assert router.stats()["misses"] == 1
+    assert router.stats()["avg_agent_ms"] == 2000.0
@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+from prometheus_client import REGISTRY
+
+from metrics import current_trace_id, observe, request_trace, timed
+
+
+def sample(name, stage):
+    return REGISTRY.get_sample_value(name, {"stage": stage}) or 0.0
+
+
+def test_observe_records_histogram_and_trace():
+    before = sample("georag_stage_duration_seconds_count", "test_stage")
+
+    with request_trace() as trace:
+        with observe("test_stage"):
+            pass
+        with observe("test_stage"):
+            pass
+
+    assert sample("georag_stage_duration_seconds_count", "test_stage") == before + 2
+    assert list(trace.timings_ms()) == ["test_stage"]
+    assert current_trace_id() is None
+
+
+def test_failed_stage_is_counted_and_reraised():
+    @timed("test_failing_stage")
+    def fail():
+        raise ValueError("boom")
+
+    before = sample("georag_stage_errors_total", "test_failing_stage")
+    with pytest.raises(ValueError):
+        fail()
+
+    assert sample("georag_stage_errors_total", "test_failing_stage") == before + 1
+
+
+def test_trace_does_not_leak_into_other_threads():
+    seen = []
+
+    with request_trace() as trace:
+        thread = threading.Thread(target=lambda: seen.append(current_trace_id()))
+        thread.start()
+        thread.join()
+        assert current_trace_id() == trace.trace_id
+
+    assert seen == [None]
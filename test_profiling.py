@@ -0,0 +1,55 @@
+import contextvars
+import threading
+import time
+
+from metrics import observe, request_trace
+from profiling import ProfileStore, Profiler, profiled
+
+
+def busy():
+    with profiled():
+        sum(i * i for i in range(10000))
+
+
+def test_capture_stores_profile_with_stage_timings(tmp_path):
+    profiler = Profiler(ProfileStore(str(tmp_path), max_entries=5), sample_rate=0)
+
+    with request_trace() as trace:
+        with profiler.capture("query", "largest cities", requested=True) as captured:
+            with observe("search_documents"):
+                worker = threading.Thread(target=contextvars.copy_context().run, args=(busy,))
+                worker.start()
+                worker.join()
+
+    [info] = profiler.store.list()
+    assert info["id"] == captured["profile_id"]
+    assert info["trace_id"] == trace.trace_id
+    assert info["threads"] == 2
+    assert "search_documents" in info["stages_ms"]
+    assert profiler.store.path(info["id"]) is not None
+
+
+def test_store_keeps_only_the_newest_profiles(tmp_path):
+    profiler = Profiler(ProfileStore(str(tmp_path), max_entries=2), sample_rate=0)
+
+    ids = []
+    for i in range(4):
+        with request_trace():
+            with profiler.capture("query", f"query {i}", requested=True) as captured:
+                busy()
+        ids.append(captured["profile_id"])
+        time.sleep(0.01)  # ids order by millisecond timestamp
+
+    assert [p["id"] for p in profiler.store.list()] == ids[:1:-1]
+    assert len(list(tmp_path.iterdir())) == 4
+
+
+def test_requests_are_not_profiled_unless_selected(tmp_path):
+    profiler = Profiler(ProfileStore(str(tmp_path)), sample_rate=0)
+
+    with profiler.capture("query", "largest cities") as captured:
+        busy()
+
+    assert captured["profile_id"] is None
+    assert profiler.store.list() == []
+    assert profiler.store.path("../app") is None
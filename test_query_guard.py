@@ -0,0 +1,77 @@
+from unittest.mock import MagicMock
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import StaticPool
+
+from fake_models import FakeStreamingChatModel
+from geo_db_toolkit import GeoDatabaseToolkit, QueryRejectedError
+
+
+@pytest.fixture
+def toolkit():
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE places (name TEXT, pop_max REAL)"))
+        connection.execute(text("INSERT INTO places VALUES ('Shanghai', 22120000)"))
+    return GeoDatabaseToolkit(engine=engine, llm=FakeStreamingChatModel(responses=["-"]))
+
+
+@pytest.mark.parametrize("sql", [
+    "DELETE FROM places",
+    "SELECT * FROM places; DROP TABLE places",
+    "SELECT * INTO copy FROM places",
+    "WITH gone AS (DELETE FROM places RETURNING *) SELECT * FROM gone",
+])
+def test_writes_are_rejected(toolkit, sql):
+    with pytest.raises(QueryRejectedError) as error:
+        toolkit.guard_query(sql)
+
+    assert error.value.reason == "not_read_only"
+    assert error.value.to_dict()["suggestion"]
+
+
+def test_keywords_inside_literals_and_comments_are_allowed(toolkit):
+    sql, note = toolkit.guard_query("-- update me\nSELECT name FROM places WHERE name <> 'delete; drop';")
+
+    assert sql.endswith("WHERE name <> 'delete; drop'")
+    assert note is None
+
+
+def test_read_only_execution_blocks_writes_and_is_undone(toolkit):
+    with pytest.raises(OperationalError):
+        toolkit.execute_query("UPDATE places SET pop_max = 0", read_only=True)
+
+    assert toolkit.execute_query("PRAGMA query_only", raw=True) == [{"query_only": 0}]
+    with toolkit.engine.begin() as connection:
+        connection.execute(text("UPDATE places SET pop_max = 1"))
+    assert toolkit.execute_query("SELECT pop_max FROM places", raw=True) == [{"pop_max": 1.0}]
+
+
+def postgres_toolkit(estimates):
+    toolkit = GeoDatabaseToolkit.__new__(GeoDatabaseToolkit)
+    toolkit.engine = MagicMock()
+    toolkit.engine.dialect.name = "postgresql"
+    toolkit.max_query_cost, toolkit.max_query_rows = 1000.0, 100
+    toolkit._explain = MagicMock(side_effect=estimates)
+    return toolkit
+
+
+def test_large_results_are_limited():
+    toolkit = postgres_toolkit([(5000.0, 20000.0), (50.0, 100.0)])
+
+    sql, note = toolkit.guard_query("SELECT name FROM places ORDER BY pop_max DESC")
+
+    assert sql == "SELECT * FROM (SELECT name FROM places ORDER BY pop_max DESC) AS limited_result LIMIT 100"
+    assert "20000 rows" in note
+
+
+def test_expensive_queries_are_rejected_with_estimates():
+    toolkit = postgres_toolkit([(90000.0, 10.0)])
+
+    with pytest.raises(QueryRejectedError) as error:
+        toolkit.guard_query("SELECT a.name FROM places a, places b WHERE a.pop_max > b.pop_max GROUP BY a.name")
+
+    assert error.value.to_dict()["reason"] == "too_expensive"
+    assert error.value.estimated_cost == 90000.0
@@ -0,0 +1,46 @@
+from result_formatter import ResultFormatter
+
+ROWS = [
+    {"name": f"Place {i}", "latitude": f"{31.2304 + i / 1000:.10f}", "longitude": 121.4737381234,
+     "pop_max": f"{1000000.0 + i}", "adm0name": "China" if i % 3 else "Japan"}
+    for i in range(200)
+]
+
+
+def test_columns_are_written_once_and_numbers_rounded():
+    text = ResultFormatter(max_rows=2).format(ROWS[:2])
+
+    assert text.splitlines() == [
+        "name | latitude | longitude | pop_max | adm0name",
+        "Place 0 | 31.2304 | 121.4737 | 1000000 | Japan",
+        "Place 1 | 31.2314 | 121.4737 | 1000001 | China",
+    ]
+
+
+def test_rows_over_the_cap_are_summarized():
+    text = ResultFormatter(max_rows=10).format(ROWS)
+
+    lines = text.splitlines()
+    assert len(lines) == 12
+    assert lines[-1].startswith("... 190 more rows not shown (200 total).")
+    assert "pop_max 1000010..1000199" in lines[-1]
+    assert "adm0name China 127, Japan 63" in lines[-1]
+    assert "name 190 distinct" in lines[-1]
+
+
+def test_token_budget_stops_before_the_row_cap():
+    formatter = ResultFormatter(max_rows=200, token_budget=150)
+
+    text = formatter.format(ROWS)
+
+    assert 1 < len(text.splitlines()) < 50
+    assert "more rows not shown" in text
+
+
+def test_columnar_payload_is_rounded_and_capped():
+    payload = ResultFormatter(payload_max_rows=3).columnar(ROWS)
+
+    assert payload["columns"] == ["name", "latitude", "longitude", "pop_max", "adm0name"]
+    assert payload["row_count"] == 200 and payload["truncated"]
+    assert payload["data"]["pop_max"] == [1000000, 1000001, 1000002]
+    assert payload["data"]["latitude"][0] == 31.2304
@@ -0,0 +1,54 @@
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from session_manager import QueryWorkerPool, QueueFull, RateLimited, RateLimiter, SessionLimitExceeded
+
+
+@pytest.fixture
+def pool():
+    pool = QueryWorkerPool(max_workers=1, max_per_session=1, max_queue=1)
+    yield pool
+    pool.shutdown(wait=False)
+
+
+def test_queries_beyond_workers_and_queue_are_rejected(pool):
+    started, release = threading.Event(), threading.Event()
+    running = pool.submit("a", lambda: started.set() or release.wait())
+    started.wait(timeout=5)
+    queued = pool.submit("b", lambda: "done")
+
+    with pytest.raises(QueueFull) as error:
+        pool.submit("c", lambda: None)
+    assert error.value.retry_after_seconds >= 1
+    assert pool.stats()["queued"] == 1
+    assert pool.stats()["rejections"] == {"queue_full": 1}
+
+    release.set()
+    running.result(timeout=5)
+    assert queued.result(timeout=5) == "done"
+
+
+def test_session_limit_applies_before_the_queue(pool):
+    release = threading.Event()
+    pool.submit("a", release.wait)
+
+    with pytest.raises(SessionLimitExceeded):
+        pool.submit("a", lambda: None)
+    release.set()
+
+
+def test_rate_limiter_allows_a_burst_then_refills(pool):
+    limiter = RateLimiter(rate_per_minute=60, burst=2, rejections=pool.rejections)
+    with patch("session_manager.time.monotonic", return_value=100.0):
+        limiter.check("client")
+        limiter.check("client")
+        with pytest.raises(RateLimited) as error:
+            limiter.check("client")
+        limiter.check("other client")
+    assert error.value.retry_after == pytest.approx(1.0)
+    assert pool.stats()["rejections"] == {"rate_limited": 1}
+
+    with patch("session_manager.time.monotonic", return_value=101.0):
+        limiter.check("client")
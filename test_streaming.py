@@ -0,0 +1,137 @@
+import asyncio
+import time
+from unittest.mock import MagicMock, patch
+
+from benchmark import create_places_standin
+from fake_models import FakeStreamingChatModel, tool_call_message
+from geo_db_toolkit import GeoDatabaseToolkit
+from geo_rag_agent import GeoRAGAgent
+
+
+def make_agent(responses, rows=None):
+    db_toolkit = MagicMock()
+    db_toolkit.execute_query.return_value = rows or []
+    db_toolkit.guard_query.side_effect = lambda sql: (sql, None)
+    db_toolkit.describe_aggregate_views.return_value = ""
+    return GeoRAGAgent(
+        llm=FakeStreamingChatModel(responses=responses),
+        doc_processor=MagicMock(),
+        db_toolkit=db_toolkit,
+    )
+
+
+def test_stream_yields_answer_tokens_then_final():
+    agent = make_agent(["Shanghai is the largest city in China."])
+
+    events = list(agent.stream("What is the largest city in China?", session_id="s1"))
+
+    tokens = [e["token"] for e in events if e["type"] == "token"]
+    final = events[-1]
+    assert final["type"] == "final"
+    assert "".join(tokens) == final["output"] == "Shanghai is the largest city in China."
+    assert final["time_to_first_token_ms"] is not None
+    assert final["time_to_first_token_ms"] <= final["total_ms"]
+    assert final["history_tokens"] == 0
+
+
+def test_stream_reports_tool_steps_before_answer():
+    agent = make_agent(
+        [tool_call_message("Execute_SQL", "SELECT name FROM places LIMIT 1"), "Found Shanghai."],
+        rows=[{"name": "Shanghai"}],
+    )
+
+    events = list(agent.stream("Name one place", session_id="s1"))
+    types = [e["type"] for e in events]
+
+    assert types.index("step") < types.index("step_result") < types.index("token")
+    step = next(e for e in events if e["type"] == "step")
+    assert step["tool"] == "Execute_SQL"
+    assert "SELECT name FROM places" in step["input"]
+    assert "Shanghai" in next(e for e in events if e["type"] == "step_result")["output"]
+    assert events[-1]["output"] == "Found Shanghai."
+
+
+def test_stream_ends_with_an_error_final_when_the_run_fails():
+    agent = make_agent(["unused"])
+
+    with patch.object(agent, "_run", side_effect=RuntimeError("database went away")):
+        events = list(agent.stream("Name one place", session_id="s1"))
+
+    assert [e["type"] for e in events] == ["final"]
+    assert events[0]["output"] == "Error: database went away"
+    assert events[0]["fast_path"] is False and events[0]["history_tokens"] == 0
+    assert events[0]["total_ms"] >= 0
+
+
+def test_stream_keeps_history_per_session():
+    agent = make_agent(["first answer", "second answer"])
+
+    list(agent.stream("first question", session_id="a"))
+    list(agent.stream("second question", session_id="b"))
+
+    assert len(agent.get_memory("a").chat_memory.messages) == 2
+    assert len(agent.get_memory("b").chat_memory.messages) == 2
+
+
+def test_queries_without_session_share_no_history():
+    agent = make_agent(["first answer", "second answer"])
+
+    agent.run("my secret question")
+    _, trace = agent.run_with_trace("what did I ask?")
+
+    assert trace["history_tokens"] == 0
+    assert agent.session_memories == {}
+    assert agent.get_memory(None).chat_memory.messages == []
+
+
+def test_least_recently_used_and_idle_sessions_are_evicted():
+    agent = make_agent(["answer"])
+    agent.max_sessions = 2
+
+    first = agent.get_memory("a")
+    agent.get_memory("b")
+    agent.get_memory("a")
+    agent.get_memory("c")
+
+    assert list(agent.session_memories) == ["a", "c"]
+    assert agent.get_memory("a") is first
+
+    with patch("geo_rag_agent.time.monotonic", return_value=time.monotonic() + 7200):
+        agent.get_memory("d")
+    assert list(agent.session_memories) == ["d"]
+
+
+def test_search_and_generate_sql_runs_both_tools():
+    agent = make_agent([
+        tool_call_message("Search_And_Generate_SQL", "cities near Shanghai"),
+        "```sql\nSELECT name FROM public.places LIMIT 5\n```",
+        "Here are the cities.",
+    ])
+    agent.doc_processor.mmr_search_documents.return_value = [
+        {"content": "Shanghai is a port city.", "metadata": {"source": "docs/shanghai.txt"}}
+    ]
+
+    events = list(agent.stream("cities near Shanghai", session_id="s1"))
+
+    result = next(e for e in events if e["type"] == "step_result")["output"]
+    assert "Shanghai is a port city." in result
+    assert result.endswith("Generated SQL:\nSELECT name FROM public.places LIMIT 5")
+    assert events[-1]["parallel_saved_ms"] >= 0
+
+
+def test_arun_runs_sql_on_the_injected_engine_and_traces_like_run():
+    toolkit = GeoDatabaseToolkit(engine=create_places_standin(10), llm=FakeStreamingChatModel(responses=["-"]))
+    agent = GeoRAGAgent(
+        llm=FakeStreamingChatModel(responses=[
+            tool_call_message("Execute_SQL", "SELECT name FROM places WHERE gid = 3"), "Found Place 3."
+        ]),
+        doc_processor=MagicMock(),
+        db_toolkit=toolkit,
+    )
+
+    output, trace = asyncio.run(agent._arun("Which place has gid 3?", None, None))
+
+    assert toolkit.async_engine is None
+    assert output == "Found Place 3."
+    assert trace["tables"][0]["data"] == {"name": ["Place 3"]}
+    assert trace["fast_path"] is False
@@ -9,9 +9,10 @@ def main():
     # Initialize document processor
     processor = DocumentProcessor(openai_api_key=os.getenv("OPENAI_API_KEY"))
     
-    # Try to load the vector store
-    if processor.load_vectorstore():
-        print("Successfully loaded FAISS index")
+    # Try to load the index shards of all collections
+    if processor.load_vectorstores():
+        for name, chunks in processor.list_collections().items():
+            print(f"Successfully loaded FAISS index of collection '{name}' ({chunks} chunks)")
         
         # Test some queries
         test_queries = [